@@ -0,0 +1,52 @@
+# Messages per second through main.on_message, for ordinary chat and for commands.
+# python benchmarks/bench_dispatch.py [--messages N] [--guilds N]
+import argparse
+import asyncio
+from time import perf_counter
+
+from fakes import make_workdir, FakeGuild, FakeMessage, FakeUser
+
+TRAFFIC = {
+    "chat": "did anyone else just get third partied in the bunker",
+    "chat starting like a prefix": "sv is down again?",
+    "unknown command": "sv!notacommand",
+    "help command": "sv!help",
+    "server command": "sv!server"
+}
+
+
+async def run(main, args):
+    await main.on_ready()
+    main.status_monitor.stop()
+    guilds = [FakeGuild(guild_id) for guild_id in range(1, args.guilds + 1)]
+    for guild in guilds:
+        await main.on_guild_join(guild)
+    author = FakeUser(1000)
+
+    for name, content in TRAFFIC.items():
+        messages = [FakeMessage(content, author, guilds[i % len(guilds)]) for i in range(args.messages)]
+        await main.on_message(messages[0])
+        # Warm up
+        start = perf_counter()
+        for message in messages:
+            await main.on_message(message)
+        duration = perf_counter() - start
+        print(name.ljust(28) + str(int(args.messages / duration)).rjust(10) + " messages/s")
+
+    await main.db_manager.close()
+    await main.surviv_api.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark on_message throughput")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--guilds", type=int, default=100)
+    args = parser.parse_args()
+
+    make_workdir()
+    import surviv_api
+    surviv_api.BASE_URL = "http://127.0.0.1:9"
+    # Nothing listens there, so any status check fails straight away
+    import main
+
+    asyncio.get_event_loop().run_until_complete(run(main, args))
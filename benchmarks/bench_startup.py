@@ -0,0 +1,78 @@
+# Time from starting python to main.py being ready to handle messages, with surviv.io answering every request
+# with a slow 502 like it does during an outage. Each run is a fresh process so imports aren't already cached.
+# python benchmarks/bench_startup.py [--runs N] [--latency S]
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+from time import perf_counter
+
+from fakes import make_workdir, FakeClient, FakeGuild
+from surviv_standin import SurvivStandIn
+
+
+async def child(main, started, imported):
+    main.bot = FakeClient([FakeGuild(guild_id) for guild_id in range(1, 51)])
+    await main.on_ready()
+    ready = perf_counter()
+    while not main.status_monitor.server_status:
+        await asyncio.sleep(0.01)
+    # The first status check carries on in the background, this is only to report when it finishes
+    status_known = perf_counter()
+
+    main.status_monitor.stop()
+    await main.db_manager.close()
+    await main.surviv_api.close()
+    print(json.dumps({
+        "import": imported - started,
+        "ready": ready - started,
+        "first status": status_known - started,
+        "status": main.status_monitor.server_status
+    }))
+
+
+def run_child(latency):
+    started = perf_counter()
+    standin = SurvivStandIn(latency=latency, jitter=0, failure_rate=1)
+    surviv_url = standin.start()
+    make_workdir({"status_poll_interval": 3600})
+    import surviv_api
+    surviv_api.BASE_URL = surviv_url
+    import main
+    imported = perf_counter()
+    asyncio.get_event_loop().run_until_complete(child(main, started, imported))
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark time to ready while surviv.io is down")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.2,
+                        help="Seconds the surviv stand-in takes to return each 502")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.latency)
+        sys.exit()
+
+    results = []
+    for _ in range(args.runs):
+        start = perf_counter()
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", "--latency", str(args.latency)],
+                                check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        result["process"] = perf_counter() - start
+        results.append(result)
+
+    print("surviv stand-in returning 502s after " + str(args.latency) + "s, " + str(args.runs) + " runs")
+    for name in ("import", "ready", "first status", "process"):
+        print(name.ljust(16) + (str(round(median([result[name] for result in results]) * 1000, 1)) + "ms").rjust(12) +
+              " median")
+    print("First status: " + str(results[-1]["status"]))
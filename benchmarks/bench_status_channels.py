@@ -0,0 +1,101 @@
+# Compares looking up status broadcast targets in the old JSON config column against the typed, indexed
+# columns, and times db_manager.setup() migrating from one to the other. Uses a throwaway sqlite database.
+# python benchmarks/bench_status_channels.py [--servers N] [--subscribed FRACTION] [--repeats N]
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_legacy_db(path, servers, subscribed):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE servers(server_id int PRIMARY KEY, config str);")
+    rows = []
+    for server_id in range(1, servers + 1):
+        channel_id = random.randrange(1, 2 ** 60) if random.random() < subscribed else 0
+        config = {"prefix": "sv!", "manager_role_id": 0, "server_status_channel": channel_id}
+        rows.append((server_id, json.dumps(config)))
+    conn.executemany("INSERT INTO servers VALUES (?, ?);", rows)
+    conn.commit()
+    return conn
+
+
+def legacy_lookup(conn):
+    # get_status_channels before the migration
+    channels = []
+    for server_id, config_str in conn.execute("SELECT server_id, config FROM servers;").fetchall():
+        channel_id = json.loads(config_str)["server_status_channel"]
+        if channel_id:
+            channels.append((server_id, channel_id))
+    return channels
+
+
+def best_time(func, repeats):
+    best = None
+    for _ in range(repeats):
+        start = perf_counter()
+        func()
+        duration = perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+async def best_time_async(func, repeats):
+    best = None
+    for _ in range(repeats):
+        start = perf_counter()
+        await func()
+        duration = perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+async def main(args):
+    environ_token = os.environ.pop("discord_token", None)
+    if environ_token:
+        print("Ignoring discord_token, this benchmark always uses sqlite")
+
+    workdir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(workdir, "data", "logs"))
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+
+    conn = make_legacy_db("./data/servers.sql", args.servers, args.subscribed)
+    expected = sorted(legacy_lookup(conn))
+    before = best_time(lambda: legacy_lookup(conn), args.repeats)
+    conn.close()
+
+    import db_manager
+    start = perf_counter()
+    await db_manager.setup()
+    migration = perf_counter() - start
+
+    if sorted(await db_manager.get_status_channels()) != expected:
+        raise AssertionError("Migrated lookup returned different channels")
+    query = "SELECT server_id, server_status_channel FROM servers WHERE server_status_channel != 0;"
+    after = best_time(lambda: db_manager.conn.execute(query).fetchall(), args.repeats)
+    after_async = await best_time_async(db_manager.get_status_channels, args.repeats)
+    await db_manager.close()
+
+    print(str(args.servers) + " servers, " + str(len(expected)) + " with a status channel")
+    print("Migration:                  " + str(round(migration * 1000, 2)) + "ms")
+    print("Lookup, JSON config column: " + str(round(before * 1000, 3)) + "ms")
+    print("Lookup, indexed columns:    " + str(round(after * 1000, 3)) + "ms (" +
+          str(round(before / after, 1)) + "x faster)")
+    print("get_status_channels():      " + str(round(after_async * 1000, 3)) + "ms, including the executor hop")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark status broadcast target lookups")
+    parser.add_argument("--servers", type=int, default=20000)
+    parser.add_argument("--subscribed", type=float, default=0.05,
+                        help="Fraction of servers with a status channel set")
+    parser.add_argument("--repeats", type=int, default=20)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,123 @@
+# Stand-ins for the discord objects the event handlers in main.py use, and a throwaway data directory
+# so main.py and db_manager.py can be imported without a real deployment.
+from itertools import count
+import json
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+message_ids = count(1)
+
+DEFAULT_CONFIG = {
+    "discord_token": "benchmark",
+    "discord_feedback_user_id": "0",
+    "discord_join_link": "https://example.com",
+    "market_enabled": True,
+    "surviv_id": "1",
+    "surviv_app_sid": "benchmark",
+    "blocked": "[]"
+}
+
+
+def make_workdir(config=None, backend="sqlite"):
+    config = dict(DEFAULT_CONFIG, **(config or {}))
+    if backend == "postgres":
+        missing = [key for key in ("db_db", "db_user", "db_pw", "db_host", "db_port") if key not in os.environ]
+        if missing:
+            raise SystemExit("Set " + ", ".join(missing) + " to benchmark against postgres")
+        print("Using the postgres database in db_db, its servers table will be overwritten")
+        for key, value in config.items():
+            os.environ[key] = value if isinstance(value, str) else json.dumps(value)
+        # main.py and db_manager.py use environment config and postgres when discord_token is set
+    elif os.environ.pop("discord_token", None):
+        print("Ignoring discord_token, using a local sqlite database")
+
+    workdir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(workdir, "data", "logs"))
+    with open(os.path.join(workdir, "data", "config.json"), "w") as file:
+        json.dump(config, file)
+    os.chdir(workdir)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    return workdir
+
+
+class FakePermissions:
+    def __init__(self, kick_members=False):
+        self.kick_members = kick_members
+
+
+class FakeUser:
+    def __init__(self, user_id, bot=False):
+        self.id = user_id
+        self.bot = bot
+        self.roles = []
+        self.guild_permissions = FakePermissions()
+
+    def __str__(self):
+        return "user" + str(self.id)
+
+
+class FakeChannel:
+    def __init__(self, channel_id, guild=None):
+        self.id = channel_id
+        self.guild = guild
+        self.sent = 0
+
+    async def send(self, content=None, embed=None):
+        self.sent += 1
+
+
+class FakeGuild:
+    def __init__(self, guild_id, owner_id=1):
+        self.id = guild_id
+        self.owner_id = owner_id
+        self.channels = {}
+
+    def add_channel(self, channel_id):
+        self.channels[channel_id] = FakeChannel(channel_id, self)
+        return self.channels[channel_id]
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    def get_role(self, role_id):
+        return None
+
+    async def leave(self):
+        pass
+
+
+class FakeClient:
+    # Replaces main.bot, the handlers only need its guild cache
+    def __init__(self, guilds=()):
+        self.guild_map = {guild.id: guild for guild in guilds}
+
+    @property
+    def guilds(self):
+        return list(self.guild_map.values())
+
+    def get_guild(self, guild_id):
+        return self.guild_map.get(guild_id)
+
+    async def close(self):
+        pass
+
+
+class FakeMessage:
+    def __init__(self, content, author, guild, channel=None):
+        self.content = content
+        self.author = author
+        self.guild = guild
+        self.channel = channel or FakeChannel(0, guild)
+        self.id = next(message_ids)
+        self.replies = 0
+        self.reactions = []
+
+    async def reply(self, content=None, embed=None):
+        self.replies += 1
+        return FakeMessage(content, FakeUser(0, bot=True), self.guild, self.channel)
+
+    async def add_reaction(self, emoji):
+        self.reactions.append(emoji)
@@ -0,0 +1,181 @@
+# Drives main.py's event handlers with synthetic guilds, messages and channel deletes, with surviv.io replaced
+# by a local stand-in, and reports throughput, command latency, event loop lag and database queries.
+# python benchmarks/load_test.py [--backend sqlite|postgres] [--messages N] [--latency S] [--failure-rate F] ...
+# The postgres backend needs db_db, db_user, db_pw, db_host and db_port set, and overwrites that database.
+import argparse
+import asyncio
+import random
+from time import perf_counter
+
+from fakes import make_workdir, FakeClient, FakeGuild, FakeMessage, FakeUser
+from surviv_standin import SurvivStandIn
+
+COMMANDS = {
+    # Name: (share of command traffic, message content)
+    "stats": (30, lambda: "sv!stats player" + str(random.randrange(200)) +
+              random.choice(("", " solo", " duos", " squads"))),
+    "stats, missing player": (5, lambda: "sv!stats missing" + str(random.randrange(50))),
+    "market": (20, lambda: "sv!market " + random.choice(("a", "l", "m", "e")) + " " +
+               random.choice(("a", "outfit", "melee", "emote")) + " " + str(random.randint(1, 5))),
+    "server": (15, lambda: "sv!server"),
+    "help": (15, lambda: "sv!help"),
+    "servercount": (5, lambda: "sv!servercount"),
+    "serverchannel": (5, None),
+    "prefix": (5, None)
+}
+CHAT = [
+    "gg",
+    "anyone want to squad up?",
+    "the new map is so much better",
+    "sv is lagging for me",
+    "who took the last 8x"
+]
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def ms(seconds):
+    return str(round(seconds * 1000, 2)) + "ms"
+
+
+async def monitor_lag(samples, interval=0.01):
+    while True:
+        start = perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(perf_counter() - start - interval)
+
+
+class LoadTest:
+    def __init__(self, main, args):
+        self.main = main
+        self.args = args
+        self.guilds = []
+        self.latencies = {}
+        self.lag = []
+        self.handled = 0
+        self.events = 0
+        self.names = list(COMMANDS)
+        self.weights = [COMMANDS[name][0] for name in self.names]
+
+    def make_guilds(self):
+        for guild_id in range(1, self.args.guilds + 1):
+            guild = FakeGuild(guild_id, owner_id=guild_id)
+            for channel_id in range(guild_id * 100, guild_id * 100 + 5):
+                guild.add_channel(channel_id)
+            self.guilds.append(guild)
+
+    def make_message(self, guild):
+        if random.random() >= self.args.command_ratio:
+            return "chat", FakeMessage(random.choice(CHAT), FakeUser(random.randrange(10 ** 6)), guild)
+
+        name = random.choices(self.names, self.weights)[0]
+        if name == "serverchannel":
+            content = "sv!serverchannel " + str(random.choice(list(guild.channels)))
+        elif name == "prefix":
+            content = "sv!prefix sv!"
+            # Settings write that leaves the prefix as it was, so the rest of the traffic keeps working
+        else:
+            content = COMMANDS[name][1]()
+        return name, FakeMessage(content, FakeUser(guild.owner_id), guild)
+
+    async def worker(self, count):
+        main = self.main
+        for _ in range(count):
+            guild = random.choice(self.guilds)
+            if random.random() < self.args.delete_ratio:
+                channel_id = random.choice(list(guild.channels))
+                await main.on_guild_channel_delete(guild.channels[channel_id])
+                self.events += 1
+                continue
+
+            name, message = self.make_message(guild)
+            start = perf_counter()
+            await main.on_message(message)
+            self.latencies.setdefault(name, []).append(perf_counter() - start)
+            self.handled += 1
+
+    async def run(self):
+        main = self.main
+        self.make_guilds()
+        main.bot = FakeClient(self.guilds)
+        await main.on_ready()
+        if not self.args.poll:
+            main.status_monitor.stop()
+        query_stats = main.db_manager.query_stats()
+
+        lag_task = asyncio.ensure_future(monitor_lag(self.lag))
+        per_worker = self.args.messages // self.args.concurrency
+        start = perf_counter()
+        await asyncio.gather(*(self.worker(per_worker) for _ in range(self.args.concurrency)))
+        duration = perf_counter() - start
+        lag_task.cancel()
+
+        main.status_monitor.stop()
+        queries = main.db_manager.query_stats()["count"] - query_stats["count"]
+        await main.db_manager.close()
+        await main.surviv_api.close()
+        self.report(duration, queries)
+        if self.args.metrics:
+            print()
+            print(main.metrics.summary())
+
+    def report(self, duration, queries):
+        print("Backend: " + self.args.backend + ", " + str(self.args.guilds) + " guilds, concurrency " +
+              str(self.args.concurrency) + ", surviv latency " + ms(self.args.latency) + ", failure rate " +
+              str(self.args.failure_rate))
+        print("Handled " + str(self.handled) + " messages and " + str(self.events) + " channel deletes in " +
+              str(round(duration, 2)) + "s, " + str(int(self.handled / duration)) + " messages/s")
+        print("DB queries: " + str(queries) + " (" + str(round(queries / max(1, self.handled), 3)) + " per message)")
+        print("Event loop lag: p50 " + ms(percentile(self.lag, 0.5)) + ", p99 " + ms(percentile(self.lag, 0.99)) +
+              ", max " + ms(max(self.lag, default=0)))
+        print()
+        print("Latency".ljust(24) + "count".rjust(8) + "p50".rjust(12) + "p99".rjust(12))
+        for name in ["chat"] + self.names:
+            samples = self.latencies.get(name)
+            if samples:
+                print(name.ljust(24) + str(len(samples)).rjust(8) + ms(percentile(samples, 0.5)).rjust(12) +
+                      ms(percentile(samples, 0.99)).rjust(12))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test main.py with a fake gateway and a local surviv.io")
+    parser.add_argument("--backend", choices=("sqlite", "postgres"), default="sqlite")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--guilds", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50,
+                        help="Messages being handled at once")
+    parser.add_argument("--command-ratio", type=float, default=0.05,
+                        help="Fraction of messages that are commands")
+    parser.add_argument("--delete-ratio", type=float, default=0.001,
+                        help="Fraction of events that are channel deletes")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Seconds the surviv stand-in takes to respond")
+    parser.add_argument("--failure-rate", type=float, default=0,
+                        help="Fraction of surviv stand-in responses that are 502s")
+    parser.add_argument("--poll", action="store_true",
+                        help="Keep the status poller running during the test")
+    parser.add_argument("--metrics", action="store_true",
+                        help="Record metrics during the test and print them afterwards")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="Keep the default cooldowns and surviv rate limit instead of turning them off")
+    args = parser.parse_args()
+
+    standin = SurvivStandIn(latency=args.latency, failure_rate=args.failure_rate)
+    surviv_url = standin.start()
+    config = {"metrics_enabled": args.metrics}
+    if not args.rate_limits:
+        config.update({"user_cooldown": 0, "guild_cooldown": 0, "surviv_rate_limit": 10 ** 6,
+                       "surviv_burst": 10 ** 6, "surviv_max_in_flight": 10 ** 6})
+    make_workdir(config, backend=args.backend)
+    import surviv_api
+    surviv_api.BASE_URL = surviv_url
+    import main
+
+    asyncio.get_event_loop().run_until_complete(LoadTest(main, args).run())
+    print()
+    print("surviv stand-in requests: " + str(standin.requests))
@@ -0,0 +1,118 @@
+# A local stand-in for the surviv.io endpoints the bot calls, run on its own thread and event loop
+# so it doesn't take time away from the bot being measured.
+import asyncio
+import random
+import threading
+
+from aiohttp import web
+
+MODE = {
+    "games": 120,
+    "kills": 300,
+    "kpg": "2.5",
+    "wins": 20,
+    "winPct": "16.7",
+    "avgDamage": "350",
+    "avgTimeAlive": "180",
+    "mostDamage": 2000,
+    "mostKills": 12
+}
+ITEM_TYPES = ["outfit", "melee", "emote", "heal_effect", "boost_effect", "deathEffect"]
+
+
+def make_stats(slug):
+    return {
+        "username": slug,
+        "banned": False,
+        "games": 360,
+        "kills": 900,
+        "wins": 60,
+        "kpg": "2.5",
+        "modes": [dict(MODE, teamMode=mode) for mode in (1, 2, 4)]
+    }
+
+
+def make_items(rarity, item_type, count):
+    items = []
+    for i in range(count):
+        items.append({
+            "item": "item" + str(i),
+            "type": item_type if item_type != "all" else ITEM_TYPES[i % len(ITEM_TYPES)],
+            "price": random.randrange(100, 100000),
+            "rarity": int(rarity) if rarity != "all" else random.randint(1, 5),
+            "makr": "player" + str(i % 50),
+            "kills": random.randrange(0, 5000),
+            "levels": random.randrange(0, 100),
+            "wins": random.randrange(0, 500)
+        })
+    return items
+
+
+class SurvivStandIn:
+    def __init__(self, latency=0.05, jitter=0.02, failure_rate=0, market_items=200):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.market_items = market_items
+        self.requests = {}
+        self.port = None
+        self.loop = None
+        self.started = threading.Event()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:" + str(self.port)
+
+    async def respond(self, request, endpoint):
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+        await asyncio.sleep(max(0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        return random.random() >= self.failure_rate
+
+    async def frontend(self, request):
+        if not await self.respond(request, "frontend"):
+            return web.Response(status=502)
+        return web.Response(text="<html></html>", content_type="text/html")
+
+    async def site_info(self, request):
+        if not await self.respond(request, "site_info"):
+            return web.Response(status=502)
+        return web.json_response({"modes": [], "pops": {}})
+
+    async def user_stats(self, request):
+        body = await request.json()
+        if not await self.respond(request, "user_stats"):
+            return web.Response(status=502)
+        if body["slug"].startswith("missing"):
+            return web.json_response(None)
+        return web.json_response(make_stats(body["slug"]))
+
+    async def market(self, request):
+        body = await request.json()
+        if not await self.respond(request, "market"):
+            return web.Response(status=502)
+        response = web.json_response({
+            "success": True,
+            "items": make_items(body["rarity"], body["type"], self.market_items)
+        })
+        response.set_cookie("app-sid", "rotated" + str(random.randrange(1000)))
+        return response
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        app = web.Application()
+        app.router.add_get("/", self.frontend)
+        app.router.add_get("/api/site_info", self.site_info)
+        app.router.add_post("/api/user_stats", self.user_stats)
+        app.router.add_post("/api/user/market/get_market_available_items", self.market)
+        runner = web.AppRunner(app)
+        self.loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        self.loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        self.started.set()
+        self.loop.run_forever()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True, name="surviv-standin").start()
+        self.started.wait()
+        return self.url
@@ -0,0 +1,62 @@
+import asyncio
+import logging
+from collections import namedtuple
+from time import monotonic
+
+import discord
+
+import metrics
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+CONCURRENCY = 20
+GLOBAL_RATE = 40
+# Messages per second across every channel, discord's global limit is 50 and other commands need some too
+
+BroadcastReport = namedtuple("BroadcastReport", ["sent", "failed", "skipped", "duration"])
+
+bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+last_report = None
+
+
+async def send(channel, embed, semaphore):
+    async with semaphore:
+        await bucket.acquire()
+        try:
+            await channel.send(embed=embed)
+        except discord.HTTPException as e:
+            # discord.py already waits out and retries 429s, so this is forbidden/missing channels or 5xxs
+            logger.info("Broadcast to channel %s failed: %r", channel.id, e)
+            return False
+    return True
+
+
+async def broadcast(bot, targets, embed):
+    global last_report
+    start = monotonic()
+
+    channels = {}
+    skipped = 0
+    for guild_id, channel_id in targets:
+        guild = bot.get_guild(guild_id)
+        channel = guild.get_channel(channel_id) if guild else None
+        if channel is None:
+            skipped += 1
+        else:
+            channels[channel_id] = channel
+    # Each channel is its own rate limit route, so one message per channel never waits on a route limit
+
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    results = await asyncio.gather(*(send(channel, embed, semaphore) for channel in channels.values()))
+
+    sent = results.count(True)
+    duration = monotonic() - start
+    last_report = BroadcastReport(sent, len(results) - sent, skipped, duration)
+    metrics.observe("broadcast_seconds", duration)
+    metrics.inc("broadcast_messages_total", (("result", "sent"),), sent)
+    metrics.inc("broadcast_messages_total", (("result", "failed"),), last_report.failed)
+    metrics.inc("broadcast_messages_total", (("result", "skipped"),), skipped)
+    logger.info("Broadcast to %s channels in %.2fs (%.1f/s), %s failed, %s skipped",
+                sent, duration, sent / duration if duration else sent, last_report.failed, skipped)
+    return last_report
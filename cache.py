@@ -0,0 +1,73 @@
+import asyncio
+from collections import OrderedDict
+from time import monotonic
+
+MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        # Key: (expiry time, value), least recently used first
+        self.in_flight = {}
+        # Key: future of the fetch that will fill it
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        self.entries[key] = (monotonic() + (self.ttl if ttl is None else ttl), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def pop(self, key):
+        entry = self.entries.pop(key, None)
+        return entry[1] if entry else None
+
+    def clear(self):
+        self.entries.clear()
+
+    async def get_or_fetch(self, key, fetch, ttl=None):
+        # ttl can also be a function of the fetched value, to keep some results for less time
+        value = self.get(key, MISSING)
+        if value is not MISSING:
+            return value
+
+        future = self.in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fetch())
+            self.in_flight[key] = future
+            future.add_done_callback(lambda done: self.fetched(key, done, ttl))
+        # Only one fetch per key at a time, everyone else waits on the same one
+        return await asyncio.shield(future)
+
+    def fetched(self, key, future, ttl):
+        del self.in_flight[key]
+        if not future.cancelled() and future.exception() is None:
+            value = future.result()
+            self.set(key, value, ttl(value) if callable(ttl) else ttl)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0
+        }
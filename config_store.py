@@ -0,0 +1,106 @@
+import asyncio
+from json import load, dump
+import logging
+from os import environ, fsync, replace
+from threading import Lock
+from types import MappingProxyType
+
+logger = logging.getLogger(__name__)
+
+SAVE_DELAY = 2
+# Seconds to wait after a change before saving, so a burst of changes is one write
+RETRY_DELAY = 30
+# Seconds before trying again after a save failed
+
+MISSING = object()
+
+
+class JsonConfig:
+    # Reads come from an immutable snapshot without locking, changes swap in a new snapshot and save it later
+    def __init__(self, file_path, executor=None):
+        with open(file_path) as file:
+            self.snapshot = MappingProxyType(load(file))
+        self.config_path = file_path
+        self.executor = executor
+        self.saved_snapshot = self.snapshot
+        self.save_handle = None
+        self.save_lock = Lock()
+        # Only held while writing the file, never by readers
+        self.saves = 0
+
+    def __getitem__(self, item):
+        return self.snapshot[item]
+
+    def __setitem__(self, key, value):
+        if self.snapshot.get(key, MISSING) == value:
+            return
+        config = dict(self.snapshot)
+        config[key] = value
+        self.snapshot = MappingProxyType(config)
+        self.schedule_save()
+
+    @property
+    def dirty(self):
+        # Only clean once the latest snapshot is on disk, so a change made while saving or a failed save isn't lost
+        return self.snapshot is not self.saved_snapshot
+
+    def schedule_save(self, delay=None):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save()
+            return
+        # Outside the event loop there's nothing to wait with, so save straight away
+
+        if self.save_handle is None:
+            self.save_handle = loop.call_later(SAVE_DELAY if delay is None else delay, self.start_save, loop)
+
+    def start_save(self, loop):
+        self.save_handle = None
+        loop.run_in_executor(self.executor, self.save).add_done_callback(self.save_done)
+
+    def save_done(self, future):
+        if future.exception() is not None:
+            logger.error("Saving config failed, trying again in %ss: %r", RETRY_DELAY, future.exception())
+            self.schedule_save(RETRY_DELAY)
+
+    def save(self):
+        with self.save_lock:
+            if not self.dirty:
+                return
+            snapshot = self.snapshot
+            temp_path = self.config_path + ".tmp"
+            with open(temp_path, mode="w") as file:
+                dump(dict(snapshot), file)
+                file.flush()
+                fsync(file.fileno())
+            replace(temp_path, self.config_path)
+            # Readers of the file only ever see the old or the new config, never half of one
+            self.saved_snapshot = snapshot
+            self.saves += 1
+            logger.debug("Saved config")
+
+    async def flush(self):
+        if self.save_handle is not None:
+            self.save_handle.cancel()
+            self.save_handle = None
+        if self.dirty:
+            await asyncio.get_event_loop().run_in_executor(self.executor, self.save)
+
+
+class HerokuConfig:
+    # Heroku config vars can't be saved from here, so changes only last until the dyno restarts
+    def __init__(self):
+        self.snapshot = MappingProxyType(dict(environ))
+
+    def __getitem__(self, item):
+        return self.snapshot[item]
+
+    def __setitem__(self, key, value):
+        config = dict(self.snapshot)
+        config[key] = value
+        self.snapshot = MappingProxyType(config)
+        environ[key] = value
+
+    async def flush(self):
+        pass
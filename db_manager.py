@@ -1,26 +1,46 @@
-from json import loads, dumps
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from json import loads
 import logging
 from os import environ
+from threading import Lock
+from time import monotonic, time
+
+import logs
+import metrics
+
+POOL_SIZE = 4
+SLOW_QUERY_TIME = 0.1
+# Seconds, slower queries are logged
+GROUP_COMMIT_DELAY = 0
+# Seconds writes wait to be committed together with others, 0 commits each write straight away
+STATUS_EVENT_RETENTION = 24 * 60 * 60
+# Seconds shared status changes are kept for
 
 conn = None
-cursor = None
+pool = None
 is_postgres = False
 if "discord_token" in environ:
-    from psycopg2 import connect
-    conn = psycopg2.connect(
+    from psycopg2.pool import ThreadedConnectionPool
+    pool = ThreadedConnectionPool(
+        1, POOL_SIZE,
         database=environ["db_db"],
         user=environ["db_user"],
         password=environ["db_pw"],
         host=environ["db_host"],
         port=environ["db_port"]
     )
-    cursor = conn.cursor()
+    executor = ThreadPoolExecutor(POOL_SIZE - 1, thread_name_prefix="db")
+    write_executor = ThreadPoolExecutor(1, thread_name_prefix="db-write")
+    # Reads can run side by side, but writes go through one thread so they commit in the order they were made
     is_postgres = True
 else:
     from sqlite3 import connect
 
-    conn = connect("./data/servers.sql")
-    cursor = conn.cursor()
+    conn = connect("./data/servers.sql", check_same_thread=False)
+    executor = write_executor = ThreadPoolExecutor(1, thread_name_prefix="db")
+    # sqlite connections can't be shared between threads at once, so all queries go through this one thread
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -28,74 +48,539 @@ if "discord_token" in environ:
     handler = logging.StreamHandler()
     formatter = logging.Formatter("db_manager - %(message)s")
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
 else:
     handler = logging.FileHandler(filename="./data/logs/db.log", encoding="utf-8")
     formatter = logging.Formatter("%(asctime)s - %(message)s")
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
+logger.addHandler(logs.queue_handler(handler))
 logger.info("Starting")
 
+SETTINGS_COLUMNS = ("prefix", "manager_role_id", "server_status_channel", "watch_channel")
+DEFAULT_SETTINGS = {
+    "prefix": "sv!",
+    "manager_role_id": 0,
+    "server_status_channel": 0,
+    "watch_channel": 0
+}
+
+CACHE_SIZE = 4096
+# Parsed configs by server id, least recently used first
+cache = OrderedDict()
+cache_hits = 0
+cache_misses = 0
+
+query_count = 0
+query_time = 0
+query_stats_lock = Lock()
 
-def exec_query(query, values):
+pending_writes = []
+# (query, values, future) waiting for the next group commit
+flush_handle = None
+
+
+def exec_query(cursor, query, values=()):
+    global query_count, query_time
     if is_postgres:
         query = query.replace("?", "%s")
+    start = monotonic()
     cursor.execute(query, values)
+    duration = monotonic() - start
 
+    with query_stats_lock:
+        query_count += 1
+        query_time += duration
+        metrics.observe("db_query_seconds", duration)
+    if duration > SLOW_QUERY_TIME:
+        logger.warning("Slow query (%.3fs): %s", duration, query)
 
-def setup():
+
+def exec_many(cursor, query, rows):
+    global query_count, query_time
     if is_postgres:
-        cursor.execute("""
-CREATE TABLE IF NOT EXISTS servers (
+        query = query.replace("?", "%s")
+    start = monotonic()
+    cursor.executemany(query, rows)
+    duration = monotonic() - start
+
+    with query_stats_lock:
+        query_count += 1
+        query_time += duration
+        metrics.observe("db_query_seconds", duration)
+    if duration > SLOW_QUERY_TIME:
+        logger.warning("Slow query (%.3fs, %s rows): %s", duration, len(rows), query)
+
+
+def with_connection(func, *args):
+    if not is_postgres:
+        return func(conn, *args)
+    pg_conn = pool.getconn()
+    try:
+        return func(pg_conn, *args)
+    finally:
+        pg_conn.rollback()
+        # Don't hand the connection back with a read transaction still open
+        pool.putconn(pg_conn)
+
+
+async def run(func, *args):
+    return await asyncio.get_event_loop().run_in_executor(executor, with_connection, func, *args)
+
+
+async def run_write(func, *args):
+    return await asyncio.get_event_loop().run_in_executor(write_executor, with_connection, func, *args)
+
+
+def fetch_one(db_conn, query, values):
+    cursor = db_conn.cursor()
+    exec_query(cursor, query, values)
+    return cursor.fetchone()
+
+
+def fetch_all(db_conn, query, values):
+    cursor = db_conn.cursor()
+    exec_query(cursor, query, values)
+    return cursor.fetchall()
+
+
+def write_batch(db_conn, writes):
+    cursor = db_conn.cursor()
+    try:
+        for query, values in writes:
+            exec_query(cursor, query, values)
+        db_conn.commit()
+    except Exception:
+        db_conn.rollback()
+        raise
+
+
+async def write(query, values):
+    global flush_handle
+    if not GROUP_COMMIT_DELAY:
+        await run_write(write_batch, [(query, values)])
+        return
+
+    future = asyncio.get_event_loop().create_future()
+    pending_writes.append((query, values, future))
+    if flush_handle is None:
+        flush_handle = asyncio.get_event_loop().call_later(GROUP_COMMIT_DELAY, start_flush)
+    await future
+
+
+def start_flush():
+    asyncio.ensure_future(flush())
+
+
+async def flush():
+    global pending_writes, flush_handle
+    if flush_handle is not None:
+        flush_handle.cancel()
+    batch = pending_writes
+    pending_writes = []
+    flush_handle = None
+    if not batch:
+        return
+
+    try:
+        await run_write(write_batch, [(query, values) for query, values, _ in batch])
+    except Exception as e:
+        logger.error("Group commit of %s writes failed: %r", len(batch), e)
+        for _, _, future in batch:
+            future.set_exception(e)
+    else:
+        for _, _, future in batch:
+            future.set_result(None)
+
+
+def cache_store(server_id, config):
+    cache[server_id] = config
+    cache.move_to_end(server_id)
+    if len(cache) > CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+def cache_stats():
+    return {
+        "size": len(cache),
+        "hits": cache_hits,
+        "misses": cache_misses
+    }
+
+
+def query_stats():
+    return {
+        "count": query_count,
+        "time": query_time
+    }
+
+
+def create_servers_table(cursor, name):
+    if is_postgres:
+        exec_query(cursor, """
+CREATE TABLE IF NOT EXISTS """ + name + """ (
     server_id BIGINT PRIMARY KEY,
-    config TEXT
+    prefix TEXT NOT NULL DEFAULT 'sv!',
+    manager_role_id BIGINT NOT NULL DEFAULT 0,
+    server_status_channel BIGINT NOT NULL DEFAULT 0,
+    watch_channel BIGINT NOT NULL DEFAULT 0
 );""")
     else:
-        cursor.execute("""
-CREATE TABLE IF NOT EXISTS servers(
+        exec_query(cursor, """
+CREATE TABLE IF NOT EXISTS """ + name + """(
     server_id int PRIMARY KEY,
-    config str
+    prefix text NOT NULL DEFAULT 'sv!',
+    manager_role_id int NOT NULL DEFAULT 0,
+    server_status_channel int NOT NULL DEFAULT 0,
+    watch_channel int NOT NULL DEFAULT 0
+);""")
+
+
+def get_columns(cursor, table):
+    if is_postgres:
+        exec_query(cursor, "SELECT column_name FROM information_schema.columns WHERE table_name = ?;", [table])
+        return [row[0] for row in cursor.fetchall()]
+    exec_query(cursor, "PRAGMA table_info(" + table + ");")
+    return [row[1] for row in cursor.fetchall()]
+
+
+def migrate_config_blob(db_conn):
+    # Settings used to be stored as a single JSON config column
+    cursor = db_conn.cursor()
+    if is_postgres:
+        exec_query(cursor, """
+ALTER TABLE servers
+    ADD COLUMN prefix TEXT NOT NULL DEFAULT 'sv!',
+    ADD COLUMN manager_role_id BIGINT NOT NULL DEFAULT 0,
+    ADD COLUMN server_status_channel BIGINT NOT NULL DEFAULT 0;""")
+        exec_query(cursor, """
+UPDATE servers SET
+    prefix = config::json->>'prefix',
+    manager_role_id = (config::json->>'manager_role_id')::BIGINT,
+    server_status_channel = (config::json->>'server_status_channel')::BIGINT;""")
+        exec_query(cursor, "ALTER TABLE servers DROP COLUMN config;")
+    else:
+        exec_query(cursor, "BEGIN;")
+        # Python's sqlite3 doesn't open a transaction for DDL by itself
+        exec_query(cursor, "SELECT server_id, config FROM servers;")
+        rows = cursor.fetchall()
+        create_servers_table(cursor, "servers_new")
+        for server_id, config_str in rows:
+            config = loads(config_str)
+            exec_query(cursor, "INSERT INTO servers_new (server_id, prefix, manager_role_id, server_status_channel) "
+                               "VALUES (?, ?, ?, ?);",
+                       (server_id, config["prefix"], config["manager_role_id"], config["server_status_channel"]))
+        exec_query(cursor, "DROP TABLE servers;")
+        exec_query(cursor, "ALTER TABLE servers_new RENAME TO servers;")
+        # Older sqlite versions can't drop columns, so the table is rebuilt instead
+    db_conn.commit()
+    logger.info("Moved server settings out of the config column")
+
+
+def create_status_tables(cursor):
+    # Server status shared from the process running the status poller to the other shard processes
+    exec_query(cursor, """
+CREATE TABLE IF NOT EXISTS status_snapshot (
+    id INTEGER PRIMARY KEY,
+    updated DOUBLE PRECISION NOT NULL,
+    status TEXT NOT NULL
+);""")
+    if is_postgres:
+        exec_query(cursor, """
+CREATE TABLE IF NOT EXISTS status_events (
+    event_id BIGSERIAL PRIMARY KEY,
+    created DOUBLE PRECISION NOT NULL,
+    changes TEXT NOT NULL
+);""")
+    else:
+        exec_query(cursor, """
+CREATE TABLE IF NOT EXISTS status_events (
+    event_id INTEGER PRIMARY KEY,
+    created DOUBLE PRECISION NOT NULL,
+    changes TEXT NOT NULL
+);""")
+
+
+def create_uptime_tables(cursor):
+    # Status history, raw samples for the last couple of days and totals per hour for older ones
+    exec_query(cursor, """
+CREATE TABLE IF NOT EXISTS uptime_samples (
+    created DOUBLE PRECISION NOT NULL,
+    service TEXT NOT NULL,
+    state SMALLINT NOT NULL
+);""")
+    exec_query(cursor, "CREATE INDEX IF NOT EXISTS uptime_samples_created ON uptime_samples (created);")
+    exec_query(cursor, """
+CREATE TABLE IF NOT EXISTS uptime_hours (
+    service TEXT NOT NULL,
+    hour BIGINT NOT NULL,
+    up INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    PRIMARY KEY (service, hour)
+);""")
+    exec_query(cursor, """
+CREATE TABLE IF NOT EXISTS uptime_outages (
+    service TEXT NOT NULL,
+    started DOUBLE PRECISION NOT NULL,
+    ended DOUBLE PRECISION,
+    planned SMALLINT NOT NULL,
+    PRIMARY KEY (service, started)
 );""")
-    conn.commit()
+
+
+def create_watch_tables(cursor):
+    exec_query(cursor, """
+CREATE TABLE IF NOT EXISTS watchlist (
+    server_id BIGINT NOT NULL,
+    slug TEXT NOT NULL,
+    PRIMARY KEY (server_id, slug)
+);""")
+    exec_query(cursor, """
+CREATE TABLE IF NOT EXISTS player_stats (
+    slug TEXT PRIMARY KEY,
+    updated DOUBLE PRECISION NOT NULL,
+    stats TEXT NOT NULL
+);""")
+    # Last stats seen for each watched player, to find what changed
+    exec_query(cursor, """
+CREATE TABLE IF NOT EXISTS leaderboard_values (
+    slug TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    value DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (slug, metric)
+);""")
+
+
+def create_tables(db_conn):
+    cursor = db_conn.cursor()
+    columns = get_columns(cursor, "servers")
+    if "config" in columns:
+        migrate_config_blob(db_conn)
+        columns = get_columns(cursor, "servers")
+    create_servers_table(cursor, "servers")
+    if columns and "watch_channel" not in columns:
+        exec_query(cursor, "ALTER TABLE servers ADD COLUMN watch_channel " +
+                   ("BIGINT" if is_postgres else "int") + " NOT NULL DEFAULT 0;")
+    exec_query(cursor, """
+CREATE INDEX IF NOT EXISTS servers_status_channel
+    ON servers (server_status_channel, server_id)
+    WHERE server_status_channel != 0;""")
+    # Only servers that want status messages, which is what broadcasts look up
+    create_status_tables(cursor)
+    create_uptime_tables(cursor)
+    create_watch_tables(cursor)
+    db_conn.commit()
+
+
+async def setup():
+    await run_write(create_tables)
     logger.info("Set up DB")
 
 
-def new_server(server_id):
-    config = {
-        "prefix": "sv!",
-        "manager_role_id": 0,
-        "server_status_channel": 0
-    }
-    config_str = dumps(config)
-    exec_query("INSERT INTO servers VALUES (?, ?);", (server_id, config_str))
-    conn.commit()
-    logger.info("Server with id " + str(server_id) + " created")
+async def close():
+    await flush()
+    # Commit anything still waiting
+    executor.shutdown(wait=True)
+    write_executor.shutdown(wait=True)
+    if is_postgres:
+        pool.closeall()
+    else:
+        conn.close()
 
 
-def get_server(server_id):
-    exec_query("SELECT * FROM servers WHERE server_id = ?;", [server_id])
-    return loads(cursor.fetchone()[1])
+async def new_server(server_id):
+    config = dict(DEFAULT_SETTINGS)
+    cache_store(server_id, config)
+    await write("INSERT INTO servers (server_id, " + ", ".join(SETTINGS_COLUMNS) + ") VALUES (?" +
+                ", ?" * len(SETTINGS_COLUMNS) + ") ON CONFLICT (server_id) DO NOTHING;",
+                [server_id] + [config[column] for column in SETTINGS_COLUMNS])
+    logger.info("Server with id %s created", server_id)
 
 
-def update_server(server_id, config):
-    logger.info("Server with id " + str(server_id) + " reconfigured")
-    config_str = dumps(config)
-    exec_query("UPDATE servers SET config = ? WHERE server_id = ?;", (config_str, server_id))
-    conn.commit()
+async def get_server(server_id):
+    global cache_hits, cache_misses
+    if server_id in cache:
+        cache_hits += 1
+        cache.move_to_end(server_id)
+        return dict(cache[server_id])
+    # Callers edit the returned dict before update_server, so the cached one is never handed out
 
+    cache_misses += 1
+    row = await run(fetch_one, "SELECT " + ", ".join(SETTINGS_COLUMNS) + " FROM servers WHERE server_id = ?;",
+                    [server_id])
+    if row is None:
+        # Either joined and on_guild_join hasn't been handled yet, or already left. Nothing is written here, so a
+        # late event for a server that was left can't bring its row back
+        return dict(DEFAULT_SETTINGS)
+    config = dict(zip(SETTINGS_COLUMNS, row))
+    cache_store(server_id, config)
+    return dict(config)
 
-def del_server(server_id):
-    logger.info("Server with id " + str(server_id) + " deleted")
-    exec_query("DELETE FROM servers WHERE server_id = ?;", [server_id])
-    conn.commit()
 
+async def update_server(server_id, config):
+    old = cache.get(server_id, {})
+    changed = [column for column in SETTINGS_COLUMNS if config[column] != old.get(column)]
+    cache_store(server_id, {column: config[column] for column in SETTINGS_COLUMNS})
+    if not changed:
+        return
+    # Only write the settings that changed
 
-def add_if_not_exists(server_id):
-    exec_query("SELECT * FROM servers WHERE server_id = ?;", [server_id])
-    if not cursor.fetchone():
-        new_server(server_id)
+    logger.info("Server with id %s reconfigured", server_id)
+    await write("INSERT INTO servers (server_id, " + ", ".join(SETTINGS_COLUMNS) + ") VALUES (?" +
+                ", ?" * len(SETTINGS_COLUMNS) + ") ON CONFLICT (server_id) DO UPDATE SET " +
+                ", ".join(column + " = excluded." + column for column in changed) + ";",
+                [server_id] + [config[column] for column in SETTINGS_COLUMNS])
+    # Inserted if the row doesn't exist yet, for a server that was only just joined
 
 
-def get_servers():
-    cursor.execute("SELECT server_id FROM servers;")
-    return cursor.fetchall()
+async def del_server(server_id):
+    logger.info("Server with id %s deleted", server_id)
+    cache.pop(server_id, None)
+    await write("DELETE FROM servers WHERE server_id = ?;", [server_id])
+    await write("DELETE FROM watchlist WHERE server_id = ?;", [server_id])
+
+
+def reconcile(db_conn, server_ids, owns):
+    cursor = db_conn.cursor()
+    try:
+        exec_query(cursor, "SELECT server_id FROM servers;")
+        stored = {row[0] for row in cursor.fetchall()}
+        joined = [(server_id,) for server_id in server_ids if server_id not in stored]
+        left = [(server_id,) for server_id in stored - set(server_ids) if owns(server_id)]
+        # Servers on shards run by other processes aren't in server_ids, but they haven't been left
+        if joined:
+            exec_many(cursor, "INSERT INTO servers (server_id) VALUES (?) ON CONFLICT (server_id) DO NOTHING;", joined)
+        if left:
+            exec_many(cursor, "DELETE FROM servers WHERE server_id = ?;", left)
+            exec_many(cursor, "DELETE FROM watchlist WHERE server_id = ?;", left)
+        db_conn.commit()
+    except Exception:
+        db_conn.rollback()
+        raise
+    return [row[0] for row in joined], [row[0] for row in left]
+
+
+async def reconcile_servers(server_ids, owns=lambda server_id: True):
+    # Add and remove servers joined or left while the bot was offline, all in one transaction
+    joined, left = await run_write(reconcile, server_ids, owns)
+    for server_id in joined:
+        cache_store(server_id, dict(DEFAULT_SETTINGS))
+    for server_id in left:
+        cache.pop(server_id, None)
+    logger.info("Reconciled servers, %s added and %s removed", len(joined), len(left))
+
+
+async def get_status_channels():
+    return await run(fetch_all,
+                     "SELECT server_id, server_status_channel FROM servers WHERE server_status_channel != 0;", ())
+
+
+async def get_prefixes():
+    rows = await run(fetch_all, "SELECT DISTINCT prefix FROM servers;", ())
+    return [row[0] for row in rows]
+
+
+async def save_status(status, changes=None):
+    await write("INSERT INTO status_snapshot VALUES (0, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET updated = excluded.updated, status = excluded.status;",
+                (time(), status))
+    if changes:
+        await write("INSERT INTO status_events (created, changes) VALUES (?, ?);", (time(), changes))
+        await write("DELETE FROM status_events WHERE created < ?;", (time() - STATUS_EVENT_RETENTION,))
+
+
+def fetch_status(db_conn, after_event_id):
+    row = fetch_one(db_conn, "SELECT status FROM status_snapshot WHERE id = 0;", ())
+    events = fetch_all(db_conn, "SELECT event_id, changes FROM status_events WHERE event_id > ? ORDER BY event_id;",
+                       (after_event_id,))
+    return row[0] if row else None, events
+
+
+async def get_status_updates(after_event_id):
+    return await run(fetch_status, after_event_id)
+
+
+async def get_last_status_event_id():
+    row = await run(fetch_one, "SELECT MAX(event_id) FROM status_events;", ())
+    return row[0] or 0
+
+
+async def save_uptime_sample(created, service, state):
+    await write("INSERT INTO uptime_samples VALUES (?, ?, ?);", (created, service, state))
+
+
+async def save_uptime_hour(service, hour, up, total):
+    await write("INSERT INTO uptime_hours VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (service, hour) DO UPDATE SET up = excluded.up, total = excluded.total;",
+                (service, hour, up, total))
+
+
+async def save_outage(service, started, ended, planned):
+    await write("INSERT INTO uptime_outages VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (service, started) DO UPDATE SET ended = excluded.ended;",
+                (service, started, ended, int(planned)))
+
+
+async def prune_uptime(samples_before, hours_before, outages_before):
+    await write("DELETE FROM uptime_samples WHERE created < ?;", (samples_before,))
+    await write("DELETE FROM uptime_hours WHERE hour < ?;", (hours_before,))
+    await write("DELETE FROM uptime_outages WHERE ended < ?;", (outages_before,))
+
+
+def fetch_uptime(db_conn, samples_after, hours_after, outages_after):
+    return (
+        fetch_all(db_conn, "SELECT created, service, state FROM uptime_samples WHERE created > ? ORDER BY created;",
+                  (samples_after,)),
+        fetch_all(db_conn, "SELECT service, hour, up, total FROM uptime_hours WHERE hour > ? ORDER BY hour;",
+                  (hours_after,)),
+        fetch_all(db_conn, "SELECT service, started, ended, planned FROM uptime_outages "
+                           "WHERE ended IS NULL OR ended > ? ORDER BY started;", (outages_after,))
+    )
+
+
+async def get_uptime_history(samples_after, hours_after, outages_after):
+    return await run(fetch_uptime, samples_after, hours_after, outages_after)
+
+
+async def add_watch(server_id, slug):
+    await write("INSERT INTO watchlist VALUES (?, ?) ON CONFLICT (server_id, slug) DO NOTHING;", (server_id, slug))
+
+
+async def remove_watch(server_id, slug):
+    await write("DELETE FROM watchlist WHERE server_id = ? AND slug = ?;", (server_id, slug))
+
+
+async def get_watches():
+    return await run(fetch_all, "SELECT server_id, slug FROM watchlist;", ())
+
+
+async def save_player_stats(slug, stats):
+    await write("INSERT INTO player_stats VALUES (?, ?, ?) "
+                "ON CONFLICT (slug) DO UPDATE SET updated = excluded.updated, stats = excluded.stats;",
+                (slug, time(), stats))
+
+
+async def get_player_stats():
+    return await run(fetch_all, "SELECT slug, stats FROM player_stats WHERE slug IN (SELECT slug FROM watchlist);", ())
+
+
+async def save_leaderboard_values(slug, values):
+    await run_write(write_batch, [("INSERT INTO leaderboard_values VALUES (?, ?, ?) "
+                                   "ON CONFLICT (slug, metric) DO UPDATE SET value = excluded.value;",
+                                   (slug, metric, value)) for metric, value in values])
+    # One transaction for every metric that changed
+
+
+async def delete_leaderboard_values(slug):
+    # Only once no server watches the player, another shard process may still have it on its leaderboards
+    await write("DELETE FROM leaderboard_values WHERE slug = ? AND NOT EXISTS "
+                "(SELECT 1 FROM watchlist WHERE watchlist.slug = ?);", (slug, slug))
+
+
+async def get_leaderboard_values():
+    # Highest first, so each leaderboard can be built in order
+    return await run(fetch_all, "SELECT watchlist.server_id, leaderboard_values.slug, metric, value "
+                                "FROM leaderboard_values JOIN watchlist ON watchlist.slug = leaderboard_values.slug "
+                                "ORDER BY value DESC, leaderboard_values.slug;", ())
+
+
+async def get_servers():
+    return await run(fetch_all, "SELECT server_id FROM servers;", ())
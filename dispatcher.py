@@ -0,0 +1,38 @@
+from collections import namedtuple
+
+Command = namedtuple("Command", ["name", "prefix", "argv"])
+# argv is the message split on spaces, argv[0] is the prefix and command name as typed
+
+
+class Dispatcher:
+    def __init__(self, commands, default_prefix):
+        self.commands = commands
+        self.prefixes = {}
+        # First character: prefixes starting with it, "" if a server has an empty prefix
+        self.add_prefix(default_prefix)
+
+    def add_prefix(self, prefix):
+        self.prefixes.setdefault(prefix[:1], set()).add(prefix)
+        # Prefixes no server uses any more are left in, they only let a few extra messages through to parse()
+
+    def could_be_command(self, content):
+        if "" in self.prefixes:
+            return True
+        if not content:
+            return False
+        prefixes = self.prefixes.get(content[0])
+        if not prefixes:
+            return False
+        for prefix in prefixes:
+            if content.startswith(prefix):
+                return True
+        return False
+
+    def parse(self, content, prefix):
+        if not content.startswith(prefix):
+            return None
+        argv = content.split(" ")
+        name = argv[0][len(prefix):].lower()
+        if name not in self.commands:
+            return None
+        return Command(name, prefix, argv)
@@ -0,0 +1,116 @@
+from bisect import bisect_left, insort
+import logging
+
+import db_manager
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ("kills", "wins", "kpg", "games")
+MODES = ("solo", "duo", "squad")
+# Same order as the modes list get_stats reads
+METRICS = FIELDS + tuple(mode + " " + field for mode in MODES for field in FIELDS)
+
+boards = {}
+# Server id: {metric: Board} for the players the server watches
+player_values = {}
+# Slug: {metric: value} from the latest stats seen
+
+
+class Board:
+    # Players ranked by one metric, kept sorted as values change so reading the top of it is just a slice
+    def __init__(self):
+        self.entries = []
+        # (-value, slug), highest value first
+        self.values = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def set(self, slug, value):
+        old = self.values.get(slug)
+        if old == value:
+            return
+        if old is not None:
+            del self.entries[bisect_left(self.entries, (-old, slug))]
+        self.values[slug] = value
+        insort(self.entries, (-value, slug))
+
+    def discard(self, slug):
+        old = self.values.pop(slug, None)
+        if old is not None:
+            del self.entries[bisect_left(self.entries, (-old, slug))]
+
+    def top(self, count):
+        return [(slug, -value) for value, slug in self.entries[:count]]
+
+
+def number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def stat_values(stats):
+    values = {field: number(stats.get(field)) for field in FIELDS}
+    for mode, mode_stats in zip(MODES, stats.get("modes", ())):
+        for field in FIELDS:
+            values[mode + " " + field] = number(mode_stats.get(field))
+    return {metric: value for metric, value in values.items() if value is not None}
+
+
+def get_board(server_id, metric):
+    return boards.get(server_id, {}).get(metric)
+
+
+async def load(owns=lambda server_id: True):
+    boards.clear()
+    player_values.clear()
+    for server_id, slug, metric, value in await db_manager.get_leaderboard_values():
+        player_values.setdefault(slug, {})[metric] = value
+        if owns(server_id):
+            board = boards.setdefault(server_id, {}).setdefault(metric, Board())
+            board.entries.append((-value, slug))
+            board.values[slug] = value
+    for server_boards in boards.values():
+        for board in server_boards.values():
+            board.entries.sort()
+    # Rows come highest first, which makes this sort cheap, but postgres orders tied slugs by its own collation,
+    # so they're sorted again to the order bisect expects
+    logger.info("Loaded leaderboards for %s servers", len(boards))
+
+
+async def update(slug, stats, server_ids):
+    # Called with each new stats snapshot for a watched player, only the metrics that changed are saved
+    values = stat_values(stats)
+    old = player_values.get(slug, {})
+    changed = [(metric, value) for metric, value in values.items() if old.get(metric) != value]
+    player_values[slug] = values
+    for server_id in server_ids:
+        server_boards = boards.setdefault(server_id, {})
+        for metric, value in values.items():
+            server_boards.setdefault(metric, Board()).set(slug, value)
+            # Does nothing for values a board already has, but a server that only just started watching gets them all
+    if changed:
+        await db_manager.save_leaderboard_values(slug, changed)
+
+
+def add_player(server_id, slug):
+    server_boards = boards.setdefault(server_id, {})
+    for metric, value in player_values.get(slug, {}).items():
+        server_boards.setdefault(metric, Board()).set(slug, value)
+
+
+def remove_player(server_id, slug):
+    for board in boards.get(server_id, {}).values():
+        board.discard(slug)
+
+
+def remove_server(server_id):
+    boards.pop(server_id, None)
+
+
+async def forget(slug):
+    # Once no server watches the player
+    player_values.pop(slug, None)
+    await db_manager.delete_leaderboard_values(slug)
@@ -0,0 +1,66 @@
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+
+MAX_BODY_LENGTH = 300
+
+listeners = []
+
+
+class Truncated:
+    # Log argument for response bodies, only cut down if the record is actually written
+    def __init__(self, text, limit=MAX_BODY_LENGTH):
+        self.text = text
+        self.limit = limit
+
+    def __str__(self):
+        if len(self.text) <= self.limit:
+            return self.text
+        return self.text[:self.limit] + "... (" + str(len(self.text)) + " characters)"
+
+
+class SamplingFilter(logging.Filter):
+    # Records logged with extra={"sample": n} are only let through once every n times, per message
+    def __init__(self):
+        super().__init__()
+        self.counts = {}
+
+    def filter(self, record):
+        every = getattr(record, "sample", None)
+        if not every:
+            return True
+        count = self.counts.get(record.msg, 0)
+        self.counts[record.msg] = count + 1
+        return count % every == 0
+
+
+class LazyQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # QueueHandler normally formats the message before queueing it, leave that to the listener thread instead.
+        # Everything stays in this process, so the record doesn't need to be made picklable
+        return record
+
+
+sampler = SamplingFilter()
+
+
+def queue_handler(*handlers):
+    # A handler that passes records to a background thread, which writes them to handlers
+    queue = SimpleQueue()
+    listener = QueueListener(queue, *handlers, respect_handler_level=True)
+    listener.start()
+    listeners.append(listener)
+
+    handler = LazyQueueHandler(queue)
+    handler.addFilter(sampler)
+    return handler
+
+
+def stop():
+    for listener in listeners:
+        listener.stop()
+    listeners.clear()
+
+
+atexit.register(stop)
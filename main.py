@@ -1,9 +1,28 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from io import BytesIO
 import logging
-from json import load, dump, loads, dumps
-from time import time
+from math import ceil
+from time import monotonic, time
+from json import loads, dumps, JSONDecodeError
 from os import environ
 import discord
+import broadcaster
 import db_manager
+import logs
+import market
+import metrics
+from cache import TTLCache
+import config_store
+import leaderboard
+from dispatcher import Dispatcher
+import ratelimit
+from ratelimit import Cooldowns, RateLimited
+import shard_sync
+import status_monitor
+import surviv_api
+import uptime
+import watchlist
 
 main_logger = logging.getLogger(__name__)
 discord_logger = logging.getLogger("discord")
@@ -15,11 +34,13 @@ if "discord_token" in environ:
     # Discord py handler
     formatter = logging.Formatter("%(name)s - %(levelname)s - %(message)s")
     main_handler.setFormatter(formatter)
+    main_queue = logs.queue_handler(main_handler)
+    # Records are written by a background thread, so logging never waits on I/O
 
-    main_logger.addHandler(main_handler)
+    main_logger.addHandler(main_queue)
     main_logger.setLevel(logging.DEBUG)
 
-    discord_logger.addHandler(main_handler)
+    discord_logger.addHandler(main_queue)
     discord_logger.setLevel(logging.INFO)
 
 else:
@@ -32,135 +53,79 @@ else:
     main_handler = logging.FileHandler(filename="./data/logs/main.log", encoding="utf-8", mode="a")
     main_handler.setLevel(logging.INFO)
     main_handler.setFormatter(formatter)
+    main_queue = logs.queue_handler(dbg_handler, main_handler)
+    # Records are written by a background thread, so logging never waits on I/O
 
-    main_logger.addHandler(dbg_handler)
-    main_logger.addHandler(main_handler)
+    main_logger.addHandler(main_queue)
     main_logger.setLevel(logging.INFO)
 
     # Discord py handler
     handler = logging.FileHandler(filename="./data/logs/discord.log", encoding="utf-8", mode="a")
     handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
-    discord_logger.addHandler(handler)
+    discord_logger.addHandler(logs.queue_handler(handler))
     discord_logger.setLevel(logging.INFO)
 
+for subsystem_logger in (surviv_api.logger, status_monitor.logger, shard_sync.logger, broadcaster.logger,
+                         metrics.logger, uptime.logger, config_store.logger, ratelimit.logger, watchlist.logger,
+                         leaderboard.logger):
+    subsystem_logger.addHandler(main_queue)
+    subsystem_logger.setLevel(main_logger.level)
+# Modules log to the same place as main, at the same level
+
 MARKET_ITEMS_PER_PAGE = 10
+MARKET_CACHE_SIZE = 64
+MARKET_SESSIONS = 1024
+MARKET_SESSION_TTL = 600
+# How many market replies can be paged with reactions at once, and for how many seconds after they're sent
+PREVIOUS_PAGE = "\u25c0\ufe0f"
+NEXT_PAGE = "\u25b6\ufe0f"
+STATS_CACHE_SIZE = 2048
+STATS_CACHE_TTL = 120
+STATS_MISSING_TTL = 30
+LEADERBOARD_SIZE = 10
 FOOTER_TEXT = "DM the bot and your feedback will be passed on the maintainer"
 
-last_update_time = time()
-update_interval = 60
-server_status = {}
-# pd: planned down
-# d: down
-# u: up
-
-
-class JsonConfig:
-    def __init__(self, file_path):
-        from threading import Lock
-        config_file = open(file_path)
-        self.config_path = file_path
-        self.config = load(config_file)
-        self.config_lock = Lock()
-
-    def __getitem__(self, item):
-        return self.config[item]
-
-    def __setitem__(self, key, value):
-        self.config_lock.acquire()
-        self.config[key] = value
-        file = open(self.config_path, mode="w")
-        dump(self.config, file)
-        file.close()
-        self.config_lock.release()
-
-
-class HerokuConfig:
-    def __init__(self):
-        from threading import Lock
-        self.lock = Lock()
-
-    def __setitem__(self, key, value):
-        self.lock.acquire()
-        from os import environ
-        environ[key] = value
-        self.lock.release()
-
-    def __getitem__(self, item):
-        self.lock.acquire()
-        from os import environ
-        result = environ[item]
-        self.lock.release()
-        return result
-
 
+config_writer = ThreadPoolExecutor(1, thread_name_prefix="config")
+# Config saves happen off the event loop, one at a time and in order
 if "discord_token" in environ:
-    config = HerokuConfig()
+    config = config_store.HerokuConfig()
 else:
-    config = JsonConfig("./data/config.json")
+    config = config_store.JsonConfig("./data/config.json", config_writer)
 
+blocked_users = frozenset(loads(config["blocked"]))
 
-def update_blocked_users(uid):
-    blocked = loads(config["blocked"])
-    blocked.append(uid)
-    config["blocked"] = dumps(blocked)
-    main_logger.info("Blocked user with id " + str(uid))
 
+def optional_config(key, default):
+    try:
+        return config[key]
+    except KeyError:
+        return default
 
-def update_stored_cookie(new_cookie):
-    config["surviv_app_sid"] = new_cookie
-    main_logger.debug("Updated cookie to " + new_cookie)
 
+def optional_flag(key, default):
+    # Heroku config values are always strings, so "false" has to be read as false rather than just being set
+    return str(optional_config(key, default)).lower() in ("1", "true", "yes")
 
-def update_server_status():
-    global last_update_time
-    last_update_time = time()
-    from requests import get, exceptions
 
-    is502 = True
-    attempts = 0
-    while is502:
-        if attempts >= 10:
-            server_status["Main"] = "ud"
-            return
+def save_blocked_users():
+    config["blocked"] = dumps(sorted(blocked_users))
 
-        try:
-            resp = get("https://surviv.io", timeout=10)
-            main_logger.debug("Got frontend response " + str(resp))
-        except exceptions.ConnectionError:
-            server_status["Main"] = "ud"
-            main_logger.info("Surviv frontend down")
-            attempts += 1
-            resp = None
-
-        if resp is None:
-            pass
-        elif resp.status_code == 503:
-            server_status["Main"] = "pd"
-            main_logger.info("Surviv frontend down")
-            is502 = False
-        elif resp.status_code == 502:
-            server_status["Main"] = "ud"
-            main_logger.info("Surviv frontend down")
-            attempts += 1
-        else:
-            server_status["main"] = "u"
-            main_logger.info("Surviv frontend up")
-            is502 = False
 
-    try:
-        get("https://surviv.io/api/site_info?language=en", timeout=10)
-        main_logger.debug("Got site info response " + str(resp))
-    except exceptions.ConnectionError:
-        server_status["API"] = "d"
-        main_logger.info("Surviv api down")
-        return
-    else:
-        server_status["API"] = "u"
-        main_logger.info("Surviv api up")
-    return
+def update_blocked_users(uid, block=True):
+    global blocked_users
+    blocked_users = blocked_users | {uid} if block else blocked_users - {uid}
+    # Swapped for a new set rather than changed in place, so on_message never sees one half updated
+    save_blocked_users()
+    main_logger.info("%s user with id %s", "Blocked" if block else "Unblocked", uid)
 
 
-def make_down_embed():
+def update_stored_cookie(new_cookie):
+    config["surviv_app_sid"] = new_cookie
+    main_logger.debug("Updated cookie to %s", new_cookie)
+
+
+def make_down_embed(changes=()):
     embed = discord.Embed(title="Server status")
     abbrev_to_full = {
         "ud": "down, unplanned",
@@ -168,28 +133,111 @@ def make_down_embed():
         "d": "down",
         "u": "up"
     }
-    embed.add_field(name="Website status", value=abbrev_to_full[server_status["main"]])
-    if server_status["main"] == "u":
-        embed.add_field(name="API status", value=abbrev_to_full[server_status["API"]])
+    service_names = {
+        "main": "Website",
+        "API": "API"
+    }
+    server_status = status_monitor.server_status
+    # Empty until the first check after startup finishes
+    for change in changes:
+        embed.add_field(name=service_names.get(change.service, change.service) + " changed",
+                        value=abbrev_to_full.get(change.old, "unknown") + " -> " +
+                        abbrev_to_full.get(change.new, "unknown"),
+                        inline=False)
+    embed.add_field(name="Website status", value=abbrev_to_full.get(server_status.get("main"), "not checked yet"))
+    if server_status.get("main") == "u":
+        embed.add_field(name="API status", value=abbrev_to_full.get(server_status.get("API"), "not checked yet"))
     embed.set_footer(text=FOOTER_TEXT)
     return embed
 
 
-async def check_update_server_status():
-    if time() > last_update_time + update_interval:
-        update_server_status()
-        embed = make_down_embed()
-        for item in server_status.items():
-            if item != "u":
-                for sid in db_manager.get_servers():
-                    server = bot.get_guild(sid[0])
-                    settings = db_manager.get_server(sid[0])
-                    if settings["server_status_channel"]:
-                        await server.get_channel(settings["server_status_channel"]).send(embed=embed)
-                break
+down_embed = None
+
 
+def cached_down_embed():
+    # Rebuilt only when a poll replaces the status snapshot, for commands answering while surviv is down
+    global down_embed
+    if down_embed is None or down_embed[0] is not status_monitor.server_status:
+        down_embed = (status_monitor.server_status, make_down_embed())
+    return down_embed[1]
 
-update_server_status()
+
+async def post_watch_changes(server_ids, stats, lines):
+    targets = []
+    for server_id in server_ids:
+        settings = await db_manager.get_server(server_id)
+        if settings["watch_channel"]:
+            targets.append((server_id, settings["watch_channel"]))
+    if not targets:
+        return
+
+    embed = discord.Embed(title=stats["username"] + " stats changed", description="\n".join(lines))
+    embed.set_footer(text=FOOTER_TEXT)
+    await broadcaster.broadcast(bot, targets, embed)
+
+
+async def broadcast_server_status(changes):
+    embed = make_down_embed(changes)
+    await broadcaster.broadcast(bot, await db_manager.get_status_channels(), embed)
+
+
+surviv_api.app_sid = optional_config("surviv_app_sid", None)
+# Not set if the market is disabled
+surviv_api.on_cookie_update = update_stored_cookie
+surviv_api.governor.bucket.rate = float(optional_config("surviv_rate_limit", surviv_api.governor.bucket.rate))
+surviv_api.governor.bucket.capacity = surviv_api.governor.bucket.tokens = float(
+    optional_config("surviv_burst", surviv_api.governor.bucket.capacity))
+surviv_api.governor.max_in_flight = int(optional_config("surviv_max_in_flight", surviv_api.governor.max_in_flight))
+surviv_api.background_governor.bucket.rate = float(optional_config("surviv_background_rate_limit",
+                                                                   surviv_api.background_governor.bucket.rate))
+surviv_api.breaker.failure_threshold = int(optional_config("surviv_breaker_threshold",
+                                                           surviv_api.breaker.failure_threshold))
+surviv_api.breaker.reset_timeout = float(optional_config("surviv_breaker_reset", surviv_api.breaker.reset_timeout))
+
+command_cooldowns = Cooldowns("commands", float(optional_config("user_cooldown", 3)),
+                              float(optional_config("guild_cooldown", 0.5)))
+# Only for stats, market and watch commands that have to ask surviv, see cooled_down
+
+status_monitor.poll_interval = float(optional_config("status_poll_interval", status_monitor.poll_interval))
+status_monitor.poll_jitter = float(optional_config("status_poll_jitter", status_monitor.poll_jitter))
+status_monitor.debounce_polls = int(optional_config("status_debounce_polls", status_monitor.debounce_polls))
+status_monitor.listeners.append(broadcast_server_status)
+
+shard_count = optional_config("shard_count", None)
+shard_ids = optional_config("shard_ids", None)
+# Set shard_ids to run only some shards in this process, like "0,1", with other processes running the rest
+if shard_ids is not None:
+    shard_ids = [int(shard_id) for shard_id in shard_ids.split(",")]
+run_status_poller = optional_flag("status_poller", True)
+if run_status_poller:
+    status_monitor.poll_listeners.append(uptime.record)
+    uptime.recording = True
+if run_status_poller and shard_ids is not None:
+    status_monitor.poll_listeners.append(shard_sync.publish)
+# Only one process polls surviv, the others pick up its results from the database
+
+watchlist.poll_interval = float(optional_config("watch_poll_interval", watchlist.poll_interval))
+watchlist.fetch = lambda slug: stats_cache.get_or_fetch(slug, lambda: fetch_stats(slug, background=True),
+                                                        ttl=stats_ttl)
+# Shares the stats cache with the stats command, so a player someone just looked up isn't fetched again
+watchlist.on_changes = post_watch_changes
+
+metrics.enabled = optional_flag("metrics_enabled", False)
+metrics.register_gauge("cache_entries", lambda: {
+    (("cache", name),): stats["size"] for name, stats in all_cache_stats().items()})
+metrics.register_gauge("circuit_open", lambda: {(("circuit", "surviv"),): int(surviv_api.breaker.is_open)})
+metrics.register_gauge("cache_hit_ratio", lambda: {
+    (("cache", name),): stats["hits"] / max(1, stats["hits"] + stats["misses"])
+    for name, stats in all_cache_stats().items()})
+
+db_manager.GROUP_COMMIT_DELAY = float(optional_config("db_group_commit_delay", db_manager.GROUP_COMMIT_DELAY))
+
+market_cache = TTLCache(MARKET_CACHE_SIZE, float(optional_config("market_cache_ttl", 300)))
+# (rarity, type): market.Catalogue, every page and search of a listing comes from one fetch
+market_sessions = TTLCache(MARKET_SESSIONS, MARKET_SESSION_TTL)
+# Reply message id: [user id, catalogue, results, page], for turning pages with reactions
+stats_cache = TTLCache(STATS_CACHE_SIZE, STATS_CACHE_TTL)
+# slug: user_stats response, falsy if the player doesn't exist
 
 
 async def syntax_error_message(message):
@@ -204,47 +252,76 @@ async def permissions_error_message(message):
     await message.reply("You do not have sufficient permissions to make this change")
 
 
-async def get_server_status(message):
-    update_server_status()
-    embed = make_down_embed()
-    await message.reply(embed=embed)
+async def surviv_down_message(message, error):
+    await message.reply("surviv.io seems to be down, try again in " + str(max(1, round(error.retry_after))) + "s",
+                        embed=cached_down_embed())
+
 
+async def rate_limited_message(message, error):
+    await message.reply("Too many requests, try again in " + str(max(1, round(error.retry_after))) + "s")
 
-async def get_market_items(message):
-    from requests import session
-    from requests.cookies import cookiejar_from_dict
-    from json import JSONDecodeError
+
+async def cooled_down(message, fetch):
+    # Only commands that have to ask surviv count towards the cooldowns, cache hits and fetches already running don't
+    command_cooldowns.check(message.author.id, message.guild.id)
+    return await fetch()
+
+
+async def get_server_status(message, command):
+    await message.reply(embed=cached_down_embed())
+
+
+async def fetch_market_items(rarity, item_type):
+    resp = await surviv_api.get_market_items(rarity, item_type, int(config["surviv_id"]))
+    main_logger.debug("Got market response %s %s", resp, logs.Truncated(resp.text), extra={"sample": 10})
+    # Make the request, the stored cookie is updated by surviv_api if it changes
+
+    if resp.status_code != 200:
+        raise surviv_api.RequestFailed("market")
+    try:
+        resp = resp.json()
+    except JSONDecodeError:
+        raise surviv_api.RequestFailed("market")
+    if not resp["success"]:
+        raise surviv_api.RequestFailed("market")
+    # Throw an error if there's a bad response or something
+    return market.Catalogue(resp["items"])
+
+
+def market_pages(results):
+    return max(1, ceil(len(results) / MARKET_ITEMS_PER_PAGE))
+
+
+def make_market_embed(catalogue, results, page_num):
+    rarities_reverse = {
+        5: "Legendary",
+        4: "Mythic",
+        3: "Epic",
+        2: "Uncommon",
+        1: "Common"
+    }
+    embed = discord.Embed(title="Page " + str(page_num) + " of " + str(market_pages(results)))
+    for number, item in catalogue.page(results, page_num, MARKET_ITEMS_PER_PAGE):
+        item_str = "Item: " + item["item"]
+        item_str += "\nType: " + item["type"]
+        item_str += "\nPrice: " + str(item["price"])
+        item_str += "\nRarity: " + str(rarities_reverse[item["rarity"]])
+        item_str += "\nMakr: " + item["makr"]
+        item_str += "\nKills: " + str(item["kills"])
+        item_str += "\nLevels: " + str(item["levels"])
+        item_str += "\nWins: " + str(item["wins"])
+        embed.add_field(name="Item " + str(number), value=item_str)
+    embed.set_footer(text=FOOTER_TEXT)
+    return embed
+
+
+async def get_market_items(message, command):
     if not config["market_enabled"]:
         await message.reply("The hoster of this bot instance has disabled this feature")
         return
 
-    def make_embed(items, page_num):
-        rarities_reverse = {
-            5: "Legendary",
-            4: "Mythic",
-            3: "Epic",
-            2: "Uncommon",
-            1: "Common"
-        }
-        embed = discord.Embed(title="Page " + str(page_num) + " of " + str(int(len(items) / MARKET_ITEMS_PER_PAGE)))
-        for item in items[(page_num - 1) * MARKET_ITEMS_PER_PAGE:page_num * MARKET_ITEMS_PER_PAGE]:
-            item_str = "Item: " + item["item"]
-            item_str += "\nType: " + item["type"]
-            item_str += "\nPrice: " + str(item["price"])
-            item_str += "\nRarity: " + str(rarities_reverse[item["rarity"]])
-            item_str += "\nMakr: " + item["makr"]
-            item_str += "\nKills: " + str(item["kills"])
-            item_str += "\nLevels: " + str(item["levels"])
-            item_str += "\nWins: " + str(item["wins"])
-            embed.add_field(name="Item " + str(items.index(item) + 1), value=item_str)
-        embed.set_footer(text=FOOTER_TEXT)
-        return embed
-
-    session = session()
-    session.cookies = cookiejar_from_dict({"app-sid": config["surviv_app_sid"]})
-
-    argv = message.content.split(" ")
-    if len(argv) != 4:
+    argv = command.argv
+    if len(argv) < 4:
         await syntax_error_message(message)
         return
 
@@ -288,6 +365,7 @@ async def get_market_items(message):
     }
     try:
         int(argv[3])
+        filters = market.parse_filters(argv[4:])
     except ValueError:
         await syntax_error_message(message)
         return
@@ -300,62 +378,86 @@ async def get_market_items(message):
     item_type = types[argv[2]]
     page = int(argv[3])
 
-    req = {
-        "rarity": rarity,
-        "type": item_type,
-        "userId": int(config["surviv_id"])
-    }
-    resp = session.post("https://surviv.io/api/user/market/get_market_available_items", json=req)
-    main_logger.debug("Got market response " + str(resp) + " " + resp.text)
-    cookies = resp.cookies.get_dict()
-    if cookies and "app-sid" in cookies:
-        update_stored_cookie(cookies["app-sid"])
-    # Make the request
-
-    if resp.status_code != 200:
-        await web_error_message(message)
-        return
     try:
-        resp = resp.json()
-    except JSONDecodeError:
-        await web_error_message(message)
+        catalogue = await market_cache.get_or_fetch(
+            (rarity, item_type), lambda: cooled_down(message, lambda: fetch_market_items(rarity, item_type)))
+    except RateLimited as e:
+        await rate_limited_message(message, e)
         return
-    if not resp["success"]:
+    except surviv_api.SurvivDown as e:
+        await surviv_down_message(message, e)
+        return
+    except surviv_api.RequestFailed:
         await web_error_message(message)
         return
-    # Throw an error if there's a bad response or something
-    await message.reply(embed=make_embed(resp["items"], page))
 
+    results = catalogue.query(**filters)
+    if not results:
+        await message.reply("No items match that search")
+        return
+    reply = await message.reply(embed=make_market_embed(catalogue, results, page))
+    if market_pages(results) > 1:
+        market_sessions.set(reply.id, [message.author.id, catalogue, results, page])
+        try:
+            await reply.add_reaction(PREVIOUS_PAGE)
+            await reply.add_reaction(NEXT_PAGE)
+        except discord.HTTPException:
+            market_sessions.pop(reply.id)
+            main_logger.info("Couldn't add market page reactions in %s", message.guild.id, extra={"sample": 10})
+            # Servers that invited the bot without Add Reactions only get the page asked for
+    # Other pages are served from the session by turn_market_page, without another command or fetch
 
-async def get_stats(message):
-    from requests import post
-    from json import JSONDecodeError
-    argv = message.content.split(" ")
 
-    if len(argv) not in (2, 3):
-        await syntax_error_message(message)
-        return
+async def fetch_stats(slug, background=False):
+    resp = await surviv_api.get_user_stats(slug, background)
+    main_logger.debug("Got stats response %s %s", resp, logs.Truncated(resp.text), extra={"sample": 10})
+
+    if resp.status_code != 200:
+        raise surviv_api.RequestFailed("user_stats")
+    try:
+        return resp.json()
+    except JSONDecodeError:
+        raise surviv_api.RequestFailed("user_stats")
+
 
-    req = {
-        "interval": "all",
-        "mapIdFilter": "-1",
-        "slug": argv[1]
+def all_cache_stats():
+    return {
+        "Guild settings": db_manager.cache_stats(),
+        "Market": market_cache.stats(),
+        "Stats": stats_cache.stats()
     }
-    resp = post("https://surviv.io/api/user_stats", json=req)
-    main_logger.debug("Got stats response " + str(resp) + " " + resp.text)
 
-    if resp.status_code != 200:
-        await web_error_message(message)
+
+def stats_ttl(stats):
+    return STATS_CACHE_TTL if stats else STATS_MISSING_TTL
+
+
+async def get_stats(message, command):
+    argv = command.argv
+
+    if len(argv) not in (2, 3):
+        await syntax_error_message(message)
         return
+
     try:
-        resp = resp.json()
-    except JSONDecodeError:
+        resp = await stats_cache.get_or_fetch(argv[1], lambda: cooled_down(message, lambda: fetch_stats(argv[1])),
+                                              ttl=stats_ttl)
+    except RateLimited as e:
+        await rate_limited_message(message, e)
+        return
+    except surviv_api.SurvivDown as e:
+        await surviv_down_message(message, e)
+        return
+    except surviv_api.RequestFailed:
         await web_error_message(message)
         return
 
     if not resp:
         await message.reply("Could not find player")
         return
+    if argv[1].lower() in watchlist.watchers:
+        await watchlist.update(argv[1].lower(), resp)
+    # Keeps watched players' snapshots and leaderboards up to date between polls
 
     if len(argv) == 2:
         embed = discord.Embed(title=resp["username"])
@@ -399,11 +501,11 @@ async def get_stats(message):
     return
 
 
-async def set_manager_role(message):
+async def set_manager_role(message, command):
     if message.author.id != message.guild.owner_id:
         await permissions_error_message(message)
         return
-    argv = message.content.split(" ")
+    argv = command.argv
     if len(argv) != 2:
         await syntax_error_message(message)
     try:
@@ -414,14 +516,14 @@ async def set_manager_role(message):
         await syntax_error_message(message)
     # Input validation
 
-    settings = db_manager.get_server(message.guild.id)
+    settings = await db_manager.get_server(message.guild.id)
     settings["manager_role_id"] = int(argv[1])
-    db_manager.update_server(message.guild.id, settings)
+    await db_manager.update_server(message.guild.id, settings)
     role = message.guild.get_role(int(argv[1]))
     await message.reply("Bot management role set to: " + str(role))
 
 
-async def leave(message):
+async def leave(message, command):
     if not message.author.guild_permissions.kick_members:
         await permissions_error_message(message)
         return
@@ -429,32 +531,33 @@ async def leave(message):
     await message.guild.leave()
 
 
-async def change_pre(message):
-    settings = db_manager.get_server(message.guild.id)
+async def change_pre(message, command):
+    settings = await db_manager.get_server(message.guild.id)
     if not (message.author.id == message.guild.owner_id or message.guild.get_role(
             settings["manager_role_id"]) in message.author.roles):
         await permissions_error_message(message)
         return
     # Input validation
 
-    argv = message.content.split(" ")
+    argv = command.argv
     if len(argv) != 2:
         await syntax_error_message(message)
         return
     old_prefix = settings["prefix"]
     settings["prefix"] = argv[1]
-    db_manager.update_server(message.guild.id, settings)
+    await db_manager.update_server(message.guild.id, settings)
+    dispatcher.add_prefix(settings["prefix"])
     await message.reply("Prefix changed from " + old_prefix + " to " + settings["prefix"])
 
 
-async def change_down_channel(message):
-    settings = db_manager.get_server(message.guild.id)
+async def change_down_channel(message, command):
+    settings = await db_manager.get_server(message.guild.id)
     if not (message.author.id == message.guild.owner_id or message.guild.get_role(
             settings["manager_role_id"]) in message.author.roles):
         await permissions_error_message(message)
         return
 
-    argv = message.content.split(" ")
+    argv = command.argv
     try:
         int(argv[1])
     except ValueError:
@@ -468,18 +571,166 @@ async def change_down_channel(message):
     settings["server_status_channel"] = int(argv[1])
     # Input validation + processing
 
-    db_manager.update_server(message.guild.id, settings)
+    await db_manager.update_server(message.guild.id, settings)
     await message.reply("Server status channel set to " + str(channel))
 
 
-async def get_server_count(message):
-    count = len(db_manager.get_servers())
+async def change_watch_channel(message, command):
+    settings = await db_manager.get_server(message.guild.id)
+    if not (message.author.id == message.guild.owner_id or message.guild.get_role(
+            settings["manager_role_id"]) in message.author.roles):
+        await permissions_error_message(message)
+        return
+
+    argv = command.argv
+    try:
+        int(argv[1])
+    except (IndexError, ValueError):
+        await syntax_error_message(message)
+        return
+
+    channel = message.guild.get_channel(int(argv[1]))
+    if not channel and int(argv[1]) != 0:
+        await syntax_error_message(message)
+        return
+    settings["watch_channel"] = int(argv[1])
+    # Input validation + processing
+
+    await db_manager.update_server(message.guild.id, settings)
+    await message.reply("Watched player changes channel set to " + str(channel))
+
+
+async def watch_player(message, command):
+    settings = await db_manager.get_server(message.guild.id)
+    if not (message.author.id == message.guild.owner_id or message.guild.get_role(
+            settings["manager_role_id"]) in message.author.roles):
+        await permissions_error_message(message)
+        return
+
+    argv = command.argv
+    if len(argv) != 2:
+        await syntax_error_message(message)
+        return
+    slug = argv[1].lower()
+    watched = watchlist.watched_by(message.guild.id)
+    if slug in watched:
+        await message.reply("Already watching " + slug)
+        return
+    if len(watched) >= watchlist.MAX_PER_SERVER:
+        await message.reply("This server is already watching " + str(len(watched)) + " players, unwatch one first")
+        return
+
+    try:
+        stats = await stats_cache.get_or_fetch(slug, lambda: cooled_down(message, lambda: fetch_stats(slug)),
+                                               ttl=stats_ttl)
+    except RateLimited as e:
+        await rate_limited_message(message, e)
+        return
+    except surviv_api.SurvivDown as e:
+        await surviv_down_message(message, e)
+        return
+    except surviv_api.RequestFailed:
+        await web_error_message(message)
+        return
+    if not stats:
+        await message.reply("Could not find player")
+        return
+
+    await watchlist.add(message.guild.id, slug, stats)
+    if settings["watch_channel"]:
+        await message.reply("Watching " + stats["username"] + ", changes will be posted in <#" +
+                            str(settings["watch_channel"]) + ">")
+    else:
+        await message.reply("Watching " + stats["username"] + ", set a channel for changes to be posted in with " +
+                            command.prefix + "watchchannel")
+
+
+async def unwatch_player(message, command):
+    settings = await db_manager.get_server(message.guild.id)
+    if not (message.author.id == message.guild.owner_id or message.guild.get_role(
+            settings["manager_role_id"]) in message.author.roles):
+        await permissions_error_message(message)
+        return
+
+    argv = command.argv
+    if len(argv) != 2:
+        await syntax_error_message(message)
+        return
+    if await watchlist.remove(message.guild.id, argv[1].lower()):
+        await message.reply("Stopped watching " + argv[1].lower())
+    else:
+        await message.reply("Not watching " + argv[1].lower())
+
+
+async def get_watchlist(message, command):
+    watched = watchlist.watched_by(message.guild.id)
+    if not watched:
+        await message.reply("No players are being watched, add one with " + command.prefix + "watch")
+        return
+    await message.reply("Watching " + str(len(watched)) + " players: " + ", ".join(watched))
+
+
+async def get_leaderboard(message, command):
+    argv = command.argv
+    field = argv[1].lower() if len(argv) > 1 else "kills"
+    mode = argv[2].lower().rstrip("s") if len(argv) > 2 else None
+    if len(argv) > 3 or field not in leaderboard.FIELDS or (mode is not None and mode not in leaderboard.MODES):
+        await syntax_error_message(message)
+        return
+    metric = field if mode is None else mode + " " + field
+
+    board = leaderboard.get_board(message.guild.id, metric)
+    if not board:
+        await message.reply("No watched players to rank yet, add some with " + command.prefix + "watch")
+        return
+
+    lines = []
+    for place, (slug, value) in enumerate(board.top(LEADERBOARD_SIZE), 1):
+        lines.append(str(place) + ". " + slug + ": " + (str(round(value, 2)) if field == "kpg" else str(int(value))))
+    embed = discord.Embed(title=("Top " + mode + " " if mode else "Top ") + field, description="\n".join(lines))
+    embed.set_footer(text=FOOTER_TEXT)
+    await message.reply(embed=embed)
+
+
+def format_duration(seconds):
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return str(minutes) + "m"
+    return str(minutes // 60) + "h " + str(minutes % 60) + "m"
+
+
+async def get_uptime(message, command):
+    await uptime.refresh()
+    now = time()
+    service_names = {
+        "main": "Website",
+        "API": "API"
+    }
+
+    embed = discord.Embed(title="Surviv uptime")
+    for service in uptime.SERVICES:
+        lines = []
+        for label, window in uptime.WINDOWS:
+            fraction = uptime.uptime(service, window, now)
+            outage_count = len(uptime.outages_since(service, now - window * 3600))
+            lines.append(label + ": " + ("no data" if fraction is None else str(round(fraction * 100, 2)) + "% up") +
+                         ", " + str(outage_count) + " outages")
+        for started, ended, planned in reversed(uptime.outages_since(service, now - 30 * 24 * 3600)[-5:]):
+            lines.append(("Planned downtime " if planned else "Down ") + "from " +
+                         datetime.utcfromtimestamp(started).strftime("%d %b %H:%M") + " UTC, " +
+                         ("ongoing" if ended is None else "for " + format_duration(ended - started)))
+        embed.add_field(name=service_names[service], value="\n".join(lines), inline=False)
+    embed.set_footer(text=FOOTER_TEXT)
+    await message.reply(embed=embed)
+
+
+async def get_server_count(message, command):
+    count = len(await db_manager.get_servers())
     await message.reply(str(count) + " servers are using this bot")
 
 
-async def help_message(message):
-    settings = db_manager.get_server(message.guild.id)
-    prefix = settings["prefix"]
+async def help_message(message, command):
+    prefix = command.prefix
 
     embed = discord.Embed(title="Commands")
     embed.add_field(name=prefix + "stats",
@@ -490,10 +741,23 @@ async def help_message(message):
                     value="Kicking/banning should have the same effect as these, only people with kick perms can use this.")
     embed.add_field(name=prefix + "prefix", value="Change the prefix which the bot responds to")
     embed.add_field(name=prefix + "server", value="Check the current status of the surviv.io servers")
+    embed.add_field(name=prefix + "uptime",
+                    value="How much of the last 24 hours, 7 days and 30 days the surviv.io servers were up, and recent outages")
     embed.add_field(name=prefix + "market",
-                    value="Get market items, arguments should be in the format [rarity] [type] [page]")
+                    value="Get market items, arguments should be in the format [rarity] [type] [page], "
+                          "optionally followed by any of price:[min]-[max] sort:[price/kills/levels/wins] "
+                          "(sort:-kills for highest first) makr:[name] name:[text]")
     embed.add_field(name=prefix + "serverchannel, " + prefix + "downchannel",
                     value="The channel to send surviv server downtime messages to. Set to 0 to disable")
+    embed.add_field(name=prefix + "watch, " + prefix + "unwatch",
+                    value="Start or stop posting changes to a player's stats, like new wins, in the watch channel. "
+                          "The name should be the same as in the stats link")
+    embed.add_field(name=prefix + "watchlist", value="List the players this server is watching")
+    embed.add_field(name=prefix + "leaderboard",
+                    value="Rank the players this server is watching, arguments can be kills, wins, kpg or games, "
+                          "optionally followed by solo, duos or squads")
+    embed.add_field(name=prefix + "watchchannel",
+                    value="The channel to post watched players' stat changes in. Set to 0 to disable")
     embed.add_field(name=prefix + "servercount", value="Say the amount of servers this bot is in")
     embed.add_field(name=prefix + "help", value="This message")
     embed.add_field(name=prefix + "inv, " + prefix + "invite", value="The invite link for this bot")
@@ -502,7 +766,7 @@ async def help_message(message):
     await message.reply(embed=embed)
 
 
-async def invite_message(message):
+async def invite_message(message, command):
     await message.reply(config["discord_join_link"])
 
 
@@ -510,6 +774,7 @@ commands = {
     "server": get_server_status,
     "servers": get_server_status,
     "down": get_server_status,
+    "uptime": get_uptime,
     "market": get_market_items,
     "stats": get_stats,
     "setmanagerrole": set_manager_role,
@@ -520,37 +785,94 @@ commands = {
     "changeprefix": change_pre,
     "serverchannel": change_down_channel,
     "downchannel": change_down_channel,
+    "watch": watch_player,
+    "unwatch": unwatch_player,
+    "watchlist": get_watchlist,
+    "leaderboard": get_leaderboard,
+    "lb": get_leaderboard,
+    "watchchannel": change_watch_channel,
     "servercount": get_server_count,
     "help": help_message,
     "inv": invite_message,
     "invite": invite_message,
     "link": invite_message,
 }
+dispatcher = Dispatcher(commands, db_manager.DEFAULT_SETTINGS["prefix"])
 
 intent = discord.Intents.none()
 intent.guild_messages = True
 intent.guilds = True
 intent.dm_messages = True
-bot = discord.Client(guild_subscriptions=False, intent=intent)
+intent.guild_reactions = True
+if shard_count is None:
+    bot = discord.Client(guild_subscriptions=False, intents=intent)
+else:
+    bot = discord.AutoShardedClient(guild_subscriptions=False, intents=intent, shard_count=int(shard_count) or None,
+                                    shard_ids=shard_ids)
+    # A shard count of 0 lets discord pick
+
+
+def owns_server(server_id):
+    if shard_ids is None:
+        return True
+    return (server_id >> 22) % int(shard_count) in shard_ids
 
 
 @bot.event
 async def on_ready():
-    db_manager.setup()
+    await db_manager.setup()
+    await uptime.load()
+    await db_manager.reconcile_servers([guild.id for guild in bot.guilds], owns_server)
+    # Before loading watchlists, so servers left while offline aren't polled for
+    await watchlist.load(owns_server)
+    watchlist.start()
+    if run_status_poller:
+        status_monitor.start()
+    # The first status check runs in the background, so a slow or failing surviv doesn't hold anything up
+    for prefix in await db_manager.get_prefixes():
+        dispatcher.add_prefix(prefix)
+    if not run_status_poller:
+        shard_sync.start_following()
+    await metrics.start(int(optional_config("metrics_port", 0)))
 
 
 @bot.event
 async def on_message(message: discord.Message):
-    await check_update_server_status()
-    if message.author.id in loads(config["blocked"]) or message.author.bot:
+    if message.author.id in blocked_users or message.author.bot:
         return
     if isinstance(message.channel, discord.DMChannel) and message.author.id == int(config["discord_feedback_user_id"]):
         if message.content == "shutdown":
+            status_monitor.stop()
+            watchlist.stop()
+            shard_sync.stop()
+            await metrics.stop()
+            await surviv_api.close()
+            await db_manager.close()
+            await config.flush()
+            config_writer.shutdown(wait=True)
             await bot.close()
+            logs.stop()
             quit()
 
-        if "block" in message.content:
-            argv = message.content.split(" ")
+        if message.content == "cachestats":
+            lines = []
+            for name, stats in all_cache_stats().items():
+                lookups = stats["hits"] + stats["misses"]
+                hit_rate = str(round(stats["hits"] / lookups * 100, 1)) + "%" if lookups else "n/a"
+                lines.append(name + ": " + str(stats["size"]) + " entries, " + str(stats["hits"]) + " hits, " +
+                             str(stats["misses"]) + " misses, " + hit_rate + " hit rate")
+            await message.reply("\n".join(lines))
+            return
+
+        if message.content == "metrics":
+            if not metrics.enabled:
+                await message.reply("Metrics are disabled, set metrics_enabled in the config to turn them on")
+                return
+            await message.reply(file=discord.File(BytesIO(metrics.summary().encode()), "metrics.txt"))
+            return
+
+        argv = message.content.split(" ")
+        if argv[0] in ("block", "unblock"):
             if len(argv) != 2:
                 await syntax_error_message(message)
                 return
@@ -561,9 +883,9 @@ async def on_message(message: discord.Message):
                 return
             # Input validation
 
-            update_blocked_users(int(argv[1]))
+            update_blocked_users(int(argv[1]), block=argv[0] == "block")
         return
-        # Block command, for feedback user only
+        # Block and unblock commands, for feedback user only
 
     if isinstance(message.channel, discord.DMChannel) and int(config["discord_feedback_user_id"]):
         feedback_user = await bot.fetch_user(int(config["discord_feedback_user_id"]))
@@ -572,36 +894,81 @@ async def on_message(message: discord.Message):
         return
         # Send DMs to feedback user
 
-    db_manager.add_if_not_exists(message.guild.id)
+    if not dispatcher.could_be_command(message.content):
+        return
+    # Most messages aren't commands, and can be dropped without looking up the server's settings
+
+    settings = await db_manager.get_server(message.guild.id)
+    command = dispatcher.parse(message.content, settings["prefix"])
+    if command:
+        if not metrics.enabled:
+            await commands[command.name](message, command)
+            return
+        start = monotonic()
+        try:
+            await commands[command.name](message, command)
+        finally:
+            metrics.observe("command_seconds", monotonic() - start, (("command", command.name),))
+
+
+async def turn_market_page(payload):
+    if payload.user_id == bot.user.id or str(payload.emoji) not in (PREVIOUS_PAGE, NEXT_PAGE):
+        return
+    session = market_sessions.get(payload.message_id)
+    if session is None or session[0] != payload.user_id:
+        return
+    # Only whoever asked for the listing can page through it
+
+    user_id, catalogue, results, page = session
+    step = 1 if str(payload.emoji) == NEXT_PAGE else -1
+    new_page = min(max(1, page + step), market_pages(results))
+    if new_page == page:
+        return
+    session[3] = new_page
+
+    channel = bot.get_channel(payload.channel_id)
+    if channel is None:
+        return
+    try:
+        await channel.get_partial_message(payload.message_id).edit(
+            embed=make_market_embed(catalogue, results, new_page))
+    except discord.HTTPException:
+        market_sessions.pop(payload.message_id)
+
 
-    settings = db_manager.get_server(message.guild.id)
-    if message.content.startswith(settings["prefix"]):
-        first_word = message.content.split(" ")[0]
-        first_word = first_word.replace(settings["prefix"], "", 1)
-        first_word = first_word.lower()
-        # Process message into command
-        if first_word in commands:
-            await commands[first_word](message)
+@bot.event
+async def on_raw_reaction_add(payload):
+    await turn_market_page(payload)
+
+
+@bot.event
+async def on_raw_reaction_remove(payload):
+    await turn_market_page(payload)
+    # Removing a reaction turns the page too, so users can keep clicking without the bot needing to clear reactions
 
 
 @bot.event
 async def on_guild_join(guild):
-    db_manager.new_server(guild.id)
+    await db_manager.new_server(guild.id)
 
 
 @bot.event
 async def on_guild_remove(guild):
-    db_manager.del_server(guild.id)
+    await db_manager.del_server(guild.id)
+    await watchlist.remove_server(guild.id)
 
 
 @bot.event
 async def on_guild_channel_delete(channel):
-    settings = db_manager.get_server(channel.guild.id)
-    if channel.id == settings["server_status_channel"]:
-        settings["server_status_channel"] = 0
-        db_manager.update_server(channel.guild.id, settings)
-
-
-main_logger.info("Starting")
-discord_logger.info("Starting")
-bot.run(config["discord_token"])
+    settings = await db_manager.get_server(channel.guild.id)
+    if channel.id in (settings["server_status_channel"], settings["watch_channel"]):
+        for column in ("server_status_channel", "watch_channel"):
+            if settings[column] == channel.id:
+                settings[column] = 0
+        await db_manager.update_server(channel.guild.id, settings)
+
+
+if __name__ == "__main__":
+    main_logger.info("Starting")
+    discord_logger.info("Starting")
+    bot.run(config["discord_token"])
@@ -0,0 +1,87 @@
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+SORT_KEYS = ("price", "kills", "levels", "wins")
+QUERY_CACHE_SIZE = 32
+
+
+class Catalogue:
+    # A market listing with indexes, so filtering and sorting it doesn't mean scanning and sorting it again
+    def __init__(self, items):
+        self.items = items
+        # Item numbers shown to users are positions in this list, in the order surviv returned them, plus one
+        self.orders = {key: sorted(range(len(items)), key=lambda i: items[i][key]) for key in SORT_KEYS}
+        self.prices = [items[i]["price"] for i in self.orders["price"]]
+        self.by_makr = {}
+        for i, item in enumerate(items):
+            self.by_makr.setdefault(item["makr"].lower(), []).append(i)
+        self.names = [item["item"].lower() for item in items]
+
+        self.results = OrderedDict()
+        # Query: item positions, so paging through a query only filters and sorts once
+
+    def query(self, min_price=None, max_price=None, makr=None, name=None, sort=None, descending=False):
+        key = (min_price, max_price, makr, name, sort, descending)
+        results = self.results.get(key)
+        if results is not None:
+            self.results.move_to_end(key)
+            return results
+
+        selected = None
+        # Positions that passed every filter so far, None if there haven't been any filters
+        if min_price is not None or max_price is not None:
+            start = 0 if min_price is None else bisect_left(self.prices, min_price)
+            end = len(self.prices) if max_price is None else bisect_right(self.prices, max_price)
+            selected = set(self.orders["price"][start:end])
+        if makr is not None:
+            matches = self.by_makr.get(makr.lower(), ())
+            selected = set(matches) if selected is None else selected.intersection(matches)
+        if name is not None:
+            name = name.lower()
+            candidates = range(len(self.items)) if selected is None else selected
+            selected = {i for i in candidates if name in self.names[i]}
+
+        if sort is None:
+            results = list(range(len(self.items))) if selected is None else sorted(selected)
+        else:
+            order = self.orders[sort][::-1] if descending else self.orders[sort]
+            results = order if selected is None else [i for i in order if i in selected]
+
+        self.results[key] = results
+        if len(self.results) > QUERY_CACHE_SIZE:
+            self.results.popitem(last=False)
+        return results
+
+    def page(self, results, page_num, per_page):
+        # (item number, item) pairs on one page of a query's results
+        return [(i + 1, self.items[i]) for i in results[(page_num - 1) * per_page:page_num * per_page]]
+
+
+def parse_filters(args):
+    # Turns arguments like price:100-500 sort:-kills makr:name name:text into Catalogue.query arguments,
+    # raises ValueError if one doesn't make sense
+    filters = {}
+    for arg in args:
+        key, sep, value = arg.partition(":")
+        key = key.lower()
+        if not sep or not value:
+            raise ValueError(arg)
+
+        if key == "price":
+            low, sep, high = value.partition("-")
+            if not sep:
+                low = high = value
+            if low:
+                filters["min_price"] = int(low)
+            if high:
+                filters["max_price"] = int(high)
+        elif key == "sort":
+            filters["descending"] = value.startswith("-")
+            filters["sort"] = value.lstrip("-").lower()
+            if filters["sort"] not in SORT_KEYS:
+                raise ValueError(arg)
+        elif key in ("makr", "name"):
+            filters[key] = value
+        else:
+            raise ValueError(arg)
+    return filters
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+from bisect import bisect_left
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+enabled = False
+# Everything below is a no-op until this is set, so the hooks cost one check when metrics are off
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LAG_INTERVAL = 0.5
+
+counters = {}
+histograms = {}
+# (name, labels): value or Histogram, labels is a tuple of (label, value) pairs
+gauges = {}
+# name: function returning {labels: value}, only called when metrics are read
+descriptions = {}
+
+lag_task = None
+server_runner = None
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.buckets[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, fraction):
+        # Upper bound of the bucket the quantile falls in
+        target = self.count * fraction
+        seen = 0
+        for bound, count in zip(BUCKETS + (float("inf"),), self.buckets):
+            seen += count
+            if seen >= target and count:
+                return bound
+        return 0
+
+
+def describe(name, description):
+    descriptions[name] = description
+
+
+def inc(name, labels=(), value=1):
+    if enabled:
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+
+def observe(name, value, labels=()):
+    if enabled:
+        key = (name, labels)
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        histogram.observe(value)
+
+
+def register_gauge(name, func):
+    gauges[name] = func
+
+
+def format_labels(labels, extra=()):
+    labels = labels + extra
+    if not labels:
+        return ""
+    return "{" + ",".join(label + '="' + str(value).replace('"', '\\"') + '"' for label, value in labels) + "}"
+
+
+def sort_key(item):
+    # Label values are compared as strings, so a number and a string in the same label can't break sorting
+    name, labels = item[0]
+    return name, [(label, str(value)) for label, value in labels]
+
+
+def render():
+    lines = []
+    written = set()
+
+    def header(name, metric_type):
+        if name not in written:
+            written.add(name)
+            if name in descriptions:
+                lines.append("# HELP " + name + " " + descriptions[name])
+            lines.append("# TYPE " + name + " " + metric_type)
+
+    for (name, labels), value in sorted(counters.items(), key=sort_key):
+        header(name, "counter")
+        lines.append(name + format_labels(labels) + " " + str(value))
+
+    for (name, labels), histogram in sorted(histograms.items(), key=sort_key):
+        header(name, "histogram")
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), histogram.buckets):
+            cumulative += count
+            lines.append(name + "_bucket" + format_labels(labels, (("le", bound),)) + " " + str(cumulative))
+        lines.append(name + "_sum" + format_labels(labels) + " " + str(histogram.sum))
+        lines.append(name + "_count" + format_labels(labels) + " " + str(histogram.count))
+
+    for name, func in sorted(gauges.items()):
+        header(name, "gauge")
+        for labels, value in func().items():
+            lines.append(name + format_labels(labels) + " " + str(value))
+    return "\n".join(lines) + "\n"
+
+
+def summary():
+    # Shorter, human readable version of render()
+    lines = []
+    for (name, labels), histogram in sorted(histograms.items(), key=sort_key):
+        lines.append(name + format_labels(labels) + ": " + str(histogram.count) + " samples, mean " +
+                     str(round(histogram.sum / histogram.count * 1000, 1)) + "ms, p50 <= " +
+                     str(histogram.quantile(0.5)) + "s, p99 <= " + str(histogram.quantile(0.99)) + "s")
+    for (name, labels), value in sorted(counters.items(), key=sort_key):
+        lines.append(name + format_labels(labels) + ": " + str(value))
+    for name, func in sorted(gauges.items()):
+        for labels, value in func().items():
+            lines.append(name + format_labels(labels) + ": " + str(round(value, 3)))
+    return "\n".join(lines)
+
+
+async def monitor_lag():
+    while True:
+        start = monotonic()
+        await asyncio.sleep(LAG_INTERVAL)
+        observe("event_loop_lag_seconds", monotonic() - start - LAG_INTERVAL)
+
+
+async def handle_metrics(request):
+    from aiohttp import web
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def start(port=0):
+    global lag_task, server_runner
+    if not enabled:
+        return
+    if lag_task is None:
+        lag_task = asyncio.ensure_future(monitor_lag())
+    if port and server_runner is None:
+        from aiohttp import web
+        # Only needed to serve metrics, so it isn't imported at startup otherwise
+        app = web.Application()
+        app.router.add_get("/metrics", handle_metrics)
+        server_runner = web.AppRunner(app)
+        await server_runner.setup()
+        await web.TCPSite(server_runner, "127.0.0.1", port).start()
+        logger.info("Serving metrics on http://127.0.0.1:%s/metrics", port)
+
+
+async def stop():
+    global lag_task, server_runner
+    if lag_task is not None:
+        lag_task.cancel()
+        lag_task = None
+    if server_runner is not None:
+        await server_runner.cleanup()
+        server_runner = None
+
+
+describe("command_seconds", "Time taken to handle each command")
+describe("surviv_request_seconds", "Time taken by requests to surviv.io")
+describe("db_query_seconds", "Time taken by database queries")
+describe("event_loop_lag_seconds", "How late the event loop was to wake a sleeping task")
+describe("broadcast_seconds", "Time taken to send a status broadcast to every subscribed channel")
+describe("broadcast_messages_total", "Status broadcast messages, by result")
+describe("cache_entries", "Entries in each cache")
+describe("cache_hit_ratio", "Fraction of cache lookups that were hits")
+describe("circuit_rejected_total", "Requests failed straight away because a circuit breaker was open")
+describe("circuit_open", "1 while a circuit breaker is open")
+describe("governor_requests_total", "Requests admitted or rejected by rate limits, by governor and reason")
@@ -0,0 +1,143 @@
+import asyncio
+from contextlib import asynccontextmanager
+import logging
+from time import monotonic
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        # Tokens per second, and the most that can build up
+        self.tokens = capacity
+        self.updated = monotonic()
+
+    def refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens=1):
+        self.refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def wait_time(self, tokens=1):
+        self.refill()
+        return max(0, (tokens - self.tokens) / self.rate)
+
+    async def acquire(self, tokens=1):
+        while not self.try_acquire(tokens):
+            await asyncio.sleep(self.wait_time(tokens))
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after, reason):
+        super().__init__(reason)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class Governor:
+    # Admission control for an upstream API, limits the request rate and how many requests are in flight at once
+    def __init__(self, name, rate, burst, max_in_flight):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+
+    def count(self, result, reason=None):
+        labels = (("governor", self.name), ("result", result))
+        metrics.inc("governor_requests_total", labels + ((("reason", reason),) if reason else ()))
+
+    @asynccontextmanager
+    async def slot(self, wait=False):
+        # Raises RateLimited straight away if there's no room, unless wait is set
+        while not (self.in_flight < self.max_in_flight and self.bucket.try_acquire()):
+            if not wait:
+                reason = "in_flight" if self.in_flight >= self.max_in_flight else "rate"
+                self.count("rejected", reason)
+                raise RateLimited(max(1, self.bucket.wait_time()), reason)
+            await asyncio.sleep(max(0.05, self.bucket.wait_time()))
+
+        self.count("admitted")
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+
+
+class Cooldowns:
+    MAX_ENTRIES = 10000
+
+    def __init__(self, name, user_cooldown, guild_cooldown):
+        self.name = name
+        self.user_cooldown = user_cooldown
+        self.guild_cooldown = guild_cooldown
+        self.ready = {}
+        # ("user" or "guild", id): time it can next be used
+
+    def check(self, user_id, guild_id):
+        now = monotonic()
+        wait = max(self.ready.get(("user", user_id), 0), self.ready.get(("guild", guild_id), 0)) - now
+        if wait > 0:
+            metrics.inc("governor_requests_total", (("governor", self.name), ("result", "rejected"),
+                                                    ("reason", "cooldown")))
+            raise RateLimited(wait, "cooldown")
+
+        metrics.inc("governor_requests_total", (("governor", self.name), ("result", "admitted")))
+        self.ready[("user", user_id)] = now + self.user_cooldown
+        self.ready[("guild", guild_id)] = now + self.guild_cooldown
+        if len(self.ready) > self.MAX_ENTRIES:
+            self.ready = {key: ready for key, ready in self.ready.items() if ready > now}
+
+
+class CircuitOpen(Exception):
+    def __init__(self, retry_after):
+        super().__init__("circuit open")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    # Stops sending requests to something that keeps failing, then lets one through now and then to see if it's back
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        # Failures in a row
+        self.opened_at = None
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def check(self):
+        # Raises CircuitOpen if requests shouldn't be sent right now
+        if self.opened_at is None:
+            return
+        waited = monotonic() - self.opened_at
+        if waited < self.reset_timeout:
+            metrics.inc("circuit_rejected_total", (("circuit", self.name),))
+            raise CircuitOpen(max(1, self.reset_timeout - waited))
+        self.opened_at = monotonic()
+        # Let this one through as a trial, the next is only let through after another reset_timeout
+
+    def success(self):
+        if self.opened_at is not None:
+            logger.info("Circuit %s closed", self.name)
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self):
+        self.failures += 1
+        if self.opened_at is None and self.failures >= self.failure_threshold:
+            self.opened_at = monotonic()
+            logger.info("Circuit %s opened after %s failures in a row", self.name, self.failures)
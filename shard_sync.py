@@ -0,0 +1,53 @@
+import asyncio
+import logging
+from json import dumps, loads
+
+import db_manager
+import status_monitor
+
+logger = logging.getLogger(__name__)
+
+FOLLOW_INTERVAL = 5
+# Seconds between checks for new status from the process running the poller
+
+last_event_id = None
+# Set from the database when following starts
+task = None
+
+
+async def publish(status, changes):
+    # Poll listener for the process running the status poller, so the others don't have to poll surviv too
+    await db_manager.save_status(dumps(status), dumps(changes) if changes else None)
+
+
+async def follow_forever():
+    global last_event_id
+    while True:
+        try:
+            if last_event_id is None:
+                last_event_id = await db_manager.get_last_status_event_id()
+                # Changes from before this process started have already been broadcast
+            status, events = await db_manager.get_status_updates(last_event_id)
+        except Exception:
+            logger.exception("Reading shared status failed")
+        else:
+            if status is not None:
+                status_monitor.server_status = loads(status)
+            for event_id, changes in events:
+                last_event_id = event_id
+                await status_monitor.notify([status_monitor.StatusChange(*change) for change in loads(changes)])
+        await asyncio.sleep(FOLLOW_INTERVAL)
+
+
+def start_following():
+    global task
+    if task is None or task.done():
+        task = asyncio.ensure_future(follow_forever())
+        logger.info("Following the shared server status every %ss", FOLLOW_INTERVAL)
+
+
+def stop():
+    global task
+    if task is not None:
+        task.cancel()
+        task = None
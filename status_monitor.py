@@ -0,0 +1,186 @@
+import asyncio
+import logging
+from collections import namedtuple
+from random import uniform
+from time import time
+
+import surviv_api
+
+logger = logging.getLogger(__name__)
+
+poll_interval = 60
+poll_jitter = 5
+# Seconds, each wait is poll_interval +- up to poll_jitter
+probe_timeout = 10
+hedge_delay = 2
+# Seconds a probe can take in total, and before a second copy of it is sent
+PROBE_ATTEMPTS = 5
+BACKOFF_BASE = 1
+BACKOFF_MAX = 16
+# Seconds to wait before retrying a failed probe, doubling each time up to BACKOFF_MAX, minus up to half for jitter
+
+last_update_time = 0
+server_status = {}
+# pd: planned down
+# d: down
+# u: up
+# Replaced as a whole after each poll, never edited in place, so readers always see a complete snapshot
+
+debounce_polls = 1
+# A new status has to be seen this many polls in a row before it counts as a change
+confirmed_status = {}
+pending = {}
+# Service: (status, polls seen in a row) for statuses that haven't been confirmed yet
+
+StatusChange = namedtuple("StatusChange", ["service", "old", "new"])
+
+listeners = []
+# Coroutine functions awaited with a list of StatusChanges after each poll that changed something
+poll_listeners = []
+# Coroutine functions awaited with the new server_status and list of changes after every poll
+task = None
+
+
+async def hedged(fetch):
+    # Sends a second request if the first is slow or fails, and uses whichever succeeds first
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + probe_timeout
+    tasks = {asyncio.ensure_future(fetch())}
+    hedge_sent = False
+    try:
+        while tasks:
+            timeout = deadline - loop.time() if hedge_sent else min(hedge_delay, deadline - loop.time())
+            if timeout <= 0:
+                break
+            done, tasks = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+            if not hedge_sent:
+                hedge_sent = True
+                tasks.add(asyncio.ensure_future(fetch()))
+    finally:
+        for task in tasks:
+            task.cancel()
+    raise surviv_api.RequestFailed("probe")
+
+
+def backoff(attempt):
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1)) * uniform(0.5, 1)
+
+
+async def check_frontend():
+    for attempt in range(PROBE_ATTEMPTS):
+        if attempt:
+            await asyncio.sleep(backoff(attempt))
+        try:
+            resp = await hedged(surviv_api.get_frontend)
+            logger.debug("Got frontend response %s", resp, extra={"sample": 10})
+        except surviv_api.RequestFailed:
+            logger.info("Surviv frontend down")
+            continue
+
+        if resp.status_code == 503:
+            logger.info("Surviv frontend down, planned")
+            return "pd"
+        if resp.status_code == 502:
+            logger.info("Surviv frontend down")
+            continue
+        logger.info("Surviv frontend up", extra={"sample": 10})
+        return "u"
+    return "ud"
+
+
+async def check_api():
+    for attempt in range(PROBE_ATTEMPTS):
+        if attempt:
+            await asyncio.sleep(backoff(attempt))
+        try:
+            resp = await hedged(surviv_api.get_site_info)
+            logger.debug("Got site info response %s", resp, extra={"sample": 10})
+        except surviv_api.RequestFailed:
+            logger.info("Surviv api down")
+            continue
+
+        if resp.status_code >= 500:
+            logger.info("Surviv api down")
+            continue
+        logger.info("Surviv api up", extra={"sample": 10})
+        return "u"
+    return "d"
+
+
+async def update_server_status():
+    global last_update_time, server_status
+    last_update_time = time()
+    main, api = await asyncio.gather(check_frontend(), check_api())
+    server_status = {"main": main, "API": api}
+
+
+def diff_status(status):
+    changes = []
+    for service, new in status.items():
+        old = confirmed_status.get(service)
+        if new == old:
+            pending.pop(service, None)
+            continue
+        if old is None:
+            confirmed_status[service] = new
+            continue
+        # The first status seen after starting is only a baseline, so restarting during an outage doesn't announce it
+        # again
+
+        seen, count = pending.get(service, (new, 0))
+        count = count + 1 if seen == new else 1
+        if count >= debounce_polls:
+            pending.pop(service, None)
+            confirmed_status[service] = new
+            changes.append(StatusChange(service, old, new))
+        else:
+            pending[service] = (new, count)
+    return changes
+
+
+async def notify(changes):
+    logger.info("Status changed: %s", ", ".join(
+        change.service + " " + str(change.old) + " -> " + change.new for change in changes))
+    for listener in listeners:
+        try:
+            await listener(changes)
+        except Exception:
+            logger.exception("Status listener failed")
+
+
+async def poll_forever():
+    while True:
+        try:
+            await update_server_status()
+        except Exception:
+            logger.exception("Status poll failed")
+            changes = []
+        else:
+            changes = diff_status(server_status)
+            for listener in poll_listeners:
+                try:
+                    await listener(server_status, changes)
+                except Exception:
+                    logger.exception("Status poll listener failed")
+
+        if changes:
+            await notify(changes)
+
+        await asyncio.sleep(max(0, poll_interval + uniform(-poll_jitter, poll_jitter)))
+
+
+def start():
+    global task
+    if task is None or task.done():
+        task = asyncio.ensure_future(poll_forever())
+        logger.info("Status poller started, polling every %ss", poll_interval)
+
+
+def stop():
+    global task
+    if task is not None:
+        task.cancel()
+        task = None
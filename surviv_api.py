@@ -0,0 +1,153 @@
+import asyncio
+import logging
+from json import loads
+from time import monotonic
+
+import aiohttp
+
+import metrics
+from ratelimit import CircuitBreaker, CircuitOpen, Governor
+
+logger = logging.getLogger(__name__)
+
+BASE_URL = "https://surviv.io"
+POOL_SIZE = 20
+KEEPALIVE_TIMEOUT = 60
+# Total seconds allowed per request, by endpoint
+TIMEOUTS = {
+    "frontend": 10,
+    "site_info": 10,
+    "user_stats": 10,
+    "market": 15,
+}
+
+governor = Governor("surviv", rate=5, burst=10, max_in_flight=10)
+# Shared by every request to surviv, so commands and background polling can't flood it between them
+background_governor = Governor("surviv_background", rate=1, burst=1, max_in_flight=2)
+# Background requests go through this first, so however much they have to do they only take a share of the
+# governor above and commands aren't left without room
+breaker = CircuitBreaker("surviv", failure_threshold=5, reset_timeout=30)
+# Opened by failures in a row, then requests fail straight away instead of each waiting for its own timeout
+
+session = None
+app_sid = None
+on_cookie_update = None
+# Called with the new app-sid whenever surviv rotates it
+
+
+class RequestFailed(Exception):
+    pass
+
+
+class SurvivDown(RequestFailed):
+    def __init__(self, retry_after):
+        super().__init__("circuit open")
+        self.retry_after = retry_after
+
+
+class Response:
+    def __init__(self, status_code, text, cookies):
+        self.status_code = status_code
+        self.text = text
+        self.cookies = cookies
+
+    def json(self):
+        return loads(self.text)
+
+    def __str__(self):
+        return "<Response [" + str(self.status_code) + "]>"
+
+
+def get_session():
+    global session
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=POOL_SIZE, keepalive_timeout=KEEPALIVE_TIMEOUT)
+        # Cookies are handled here rather than by the session, so only app-sid is ever sent
+        session = aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar())
+    return session
+
+
+async def close():
+    if session is not None and not session.closed:
+        await session.close()
+
+
+def store_cookies(cookies):
+    global app_sid
+    if "app-sid" in cookies and cookies["app-sid"] != app_sid:
+        app_sid = cookies["app-sid"]
+        if on_cookie_update:
+            on_cookie_update(app_sid)
+
+
+async def request(method, endpoint, path, json=None, with_cookie=False, wait=False, probe=False, background=False):
+    # Raises RateLimited if the governor has no room, unless wait or background is set, and SurvivDown while the
+    # circuit is open. Probes go through an open circuit, they're how it finds out surviv is back
+    if not probe:
+        try:
+            breaker.check()
+        except CircuitOpen as e:
+            raise SurvivDown(e.retry_after) from None
+    if background:
+        async with background_governor.slot(wait=True):
+            return await send(method, endpoint, path, json, with_cookie, wait=True)
+    return await send(method, endpoint, path, json, with_cookie, wait)
+
+
+async def send(method, endpoint, path, json, with_cookie, wait):
+    headers = {}
+    if with_cookie and app_sid:
+        headers["Cookie"] = "app-sid=" + app_sid
+    timeout = aiohttp.ClientTimeout(total=TIMEOUTS[endpoint])
+
+    async with governor.slot(wait):
+        start = monotonic()
+        try:
+            async with get_session().request(method, BASE_URL + path, json=json, headers=headers,
+                                             timeout=timeout) as resp:
+                text = await resp.text()
+                cookies = {name: morsel.value for name, morsel in resp.cookies.items()}
+                status_code = resp.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            metrics.observe("surviv_request_seconds", monotonic() - start,
+                            (("endpoint", endpoint), ("status", "error")))
+            logger.info("Request to %s failed: %r", endpoint, e)
+            breaker.failure()
+            raise RequestFailed(endpoint) from e
+    metrics.observe("surviv_request_seconds", monotonic() - start,
+                    (("endpoint", endpoint), ("status", str(status_code))))
+    if status_code >= 500:
+        breaker.failure()
+    else:
+        breaker.success()
+
+    if with_cookie:
+        store_cookies(cookies)
+    return Response(status_code, text, cookies)
+
+
+async def get_frontend():
+    return await request("GET", "frontend", "/", wait=True, probe=True)
+
+
+async def get_site_info():
+    return await request("GET", "site_info", "/api/site_info?language=en", wait=True, probe=True)
+
+
+async def get_user_stats(slug, background=False):
+    req = {
+        "interval": "all",
+        "mapIdFilter": "-1",
+        "slug": slug
+    }
+    return await request("POST", "user_stats", "/api/user_stats", json=req, background=background)
+
+
+async def get_market_items(rarity, item_type, user_id):
+    req = {
+        "rarity": rarity,
+        "type": item_type,
+        "userId": user_id
+    }
+    return await request("POST", "market", "/api/user/market/get_market_available_items", json=req,
+                         with_cookie=True)
@@ -0,0 +1,179 @@
+from array import array
+from collections import OrderedDict
+import logging
+from time import time
+
+import db_manager
+
+logger = logging.getLogger(__name__)
+
+SERVICES = ("main", "API")
+UP = 1
+DOWN = 0
+PLANNED = 2
+STATES = {"u": UP, "d": DOWN, "ud": DOWN, "pd": PLANNED}
+
+RAW_CAPACITY = 4096
+RAW_RETENTION = 2 * 24 * 60 * 60
+# Raw samples are kept for this many seconds, enough for two days of polls every minute
+HOUR_RETENTION = 31 * 24
+# Hours of per hour totals kept, older history is dropped
+WINDOWS = (("24h", 24), ("7d", 7 * 24), ("30d", 30 * 24))
+RELOAD_INTERVAL = 60
+# Seconds between reloading history from the database, in processes that don't poll the status themselves
+
+
+class Ring:
+    # Fixed size array backed buffer of (time, state) samples, the oldest is overwritten when it's full
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array("d", bytes(8 * capacity))
+        self.states = array("b", bytes(capacity))
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, created, state):
+        index = (self.start + self.size) % self.capacity
+        self.times[index] = created
+        self.states[index] = state
+        if self.size < self.capacity:
+            self.size += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+
+    def newest_first(self):
+        for offset in range(self.size - 1, -1, -1):
+            index = (self.start + offset) % self.capacity
+            yield self.times[index], self.states[index]
+
+
+samples = {service: Ring(RAW_CAPACITY) for service in SERVICES}
+hours = {service: OrderedDict() for service in SERVICES}
+# Service: {hour number: [up samples, total samples]}, oldest first, only for hours that are over
+outages = {service: [] for service in SERVICES}
+# Service: [[start, end or None if ongoing, planned]], oldest first
+
+recording = False
+# Only set in the process that polls the status, the others reload what it saved
+loaded_at = 0
+pruned_hour = None
+
+
+def hour_of(timestamp):
+    return int(timestamp // 3600)
+
+
+def clear():
+    for service in SERVICES:
+        samples[service] = Ring(RAW_CAPACITY)
+        hours[service].clear()
+        outages[service].clear()
+
+
+async def load():
+    global loaded_at
+    now = time()
+    sample_rows, hour_rows, outage_rows = await db_manager.get_uptime_history(
+        now - RAW_RETENTION, hour_of(now) - HOUR_RETENTION, now - HOUR_RETENTION * 3600)
+    clear()
+    for created, service, state in sample_rows:
+        if service in samples:
+            samples[service].append(created, state)
+    for service, hour, up, total in hour_rows:
+        if service in hours:
+            hours[service][hour] = [up, total]
+    for service, started, ended, planned in outage_rows:
+        if service in outages:
+            outages[service].append([started, ended, bool(planned)])
+    loaded_at = now
+    logger.info("Loaded %s uptime samples, %s hours and %s outages", len(sample_rows), len(hour_rows),
+                len(outage_rows))
+
+
+async def refresh():
+    if not recording and time() - loaded_at > RELOAD_INTERVAL:
+        await load()
+
+
+async def downsample(service, current_hour):
+    # Totals up raw samples from finished hours that haven't been totalled yet
+    service_hours = hours[service]
+    done = next(reversed(service_hours)) if service_hours else -1
+    totals = {}
+    for created, state in samples[service].newest_first():
+        hour = hour_of(created)
+        if hour <= done:
+            break
+        if hour < current_hour:
+            counts = totals.setdefault(hour, [0, 0])
+            counts[0] += state == UP
+            counts[1] += 1
+
+    for hour in sorted(totals):
+        service_hours[hour] = totals[hour]
+        await db_manager.save_uptime_hour(service, hour, *totals[hour])
+    while service_hours and next(iter(service_hours)) <= current_hour - HOUR_RETENTION:
+        service_hours.popitem(last=False)
+
+
+async def record(status, changes):
+    # Poll listener, every sample goes into the ring buffer and the database
+    global pruned_hour
+    now = time()
+    hour = hour_of(now)
+    for service in SERVICES:
+        if service not in status:
+            continue
+        state = STATES.get(status[service], DOWN)
+        ring = samples[service]
+        last = next(ring.newest_first(), None)
+        if last is not None and hour_of(last[0]) < hour:
+            await downsample(service, hour)
+        ring.append(now, state)
+        await db_manager.save_uptime_sample(now, service, state)
+
+        service_outages = outages[service]
+        ongoing = service_outages and service_outages[-1][1] is None
+        if state != UP and not ongoing:
+            service_outages.append([now, None, state == PLANNED])
+            await db_manager.save_outage(service, now, None, state == PLANNED)
+        elif state == UP and ongoing:
+            outage = service_outages[-1]
+            outage[1] = now
+            await db_manager.save_outage(service, outage[0], now, outage[2])
+        while service_outages and service_outages[0][1] is not None and \
+                service_outages[0][1] < now - HOUR_RETENTION * 3600:
+            service_outages.pop(0)
+
+    if pruned_hour != hour:
+        pruned_hour = hour
+        await db_manager.prune_uptime(now - RAW_RETENTION, hour - HOUR_RETENTION, now - HOUR_RETENTION * 3600)
+
+
+def uptime(service, window_hours, now=None):
+    # Fraction of samples that were up in the last window_hours hours, None if there aren't any
+    now = time() if now is None else now
+    current_hour = hour_of(now)
+    up = total = 0
+    for hour, (hour_up, hour_total) in reversed(hours[service].items()):
+        if hour <= current_hour - window_hours:
+            break
+        up += hour_up
+        total += hour_total
+
+    done = next(reversed(hours[service])) if hours[service] else -1
+    for created, state in samples[service].newest_first():
+        hour = hour_of(created)
+        if hour <= done or hour <= current_hour - window_hours:
+            break
+        # Samples not totalled into hours yet, at most an hour or so of them
+        up += state == UP
+        total += 1
+    return up / total if total else None
+
+
+def outages_since(service, since):
+    return [outage for outage in outages[service] if outage[1] is None or outage[1] > since]
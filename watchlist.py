@@ -0,0 +1,186 @@
+import asyncio
+from json import dumps, loads
+import logging
+
+import db_manager
+import leaderboard
+import surviv_api
+
+logger = logging.getLogger(__name__)
+
+poll_interval = 300
+# Seconds between checking every watched player
+CONCURRENCY = 4
+MAX_PER_SERVER = 25
+COUNTED_FIELDS = ("games", "kills", "wins")
+MODE_NAMES = ("Solo", "Duo", "Squad")
+# Same order as the modes list get_stats reads
+
+watchers = {}
+# Slug: ids of the servers watching it, each slug is fetched once per poll however many servers watch it
+by_server = {}
+# Server id: slugs it watches
+snapshots = {}
+# Slug: last stats seen
+
+fetch = None
+# Coroutine function returning the stats for a slug, falsy if the player doesn't exist
+on_changes = None
+# Coroutine function awaited with (server ids, stats, lines describing what changed)
+task = None
+
+
+async def load(owns=lambda server_id: True):
+    # Only servers this process owns, with several shard processes each polls for its own servers
+    watchers.clear()
+    by_server.clear()
+    for server_id, slug in await db_manager.get_watches():
+        if owns(server_id):
+            watchers.setdefault(slug, set()).add(server_id)
+            by_server.setdefault(server_id, set()).add(slug)
+    snapshots.clear()
+    for slug, stats in await db_manager.get_player_stats():
+        if slug in watchers:
+            snapshots[slug] = loads(stats)
+
+    await leaderboard.load(owns)
+    for slug, stats in snapshots.items():
+        if slug not in leaderboard.player_values:
+            await leaderboard.update(slug, stats, watchers[slug])
+    # Players watched before there were leaderboards
+    logger.info("Loaded %s watched players for %s servers", len(watchers), len(by_server))
+
+
+def watched_by(server_id):
+    return sorted(by_server.get(server_id, ()))
+
+
+async def add(server_id, slug, stats=None):
+    watchers.setdefault(slug, set()).add(server_id)
+    by_server.setdefault(server_id, set()).add(slug)
+    await db_manager.add_watch(server_id, slug)
+    # Stats already fetched when the watch was added are the baseline for the first poll
+    if stats and slug not in snapshots:
+        await store(slug, stats)
+    else:
+        leaderboard.add_player(server_id, slug)
+
+
+async def remove(server_id, slug):
+    if slug not in by_server.get(server_id, ()):
+        return False
+    by_server[server_id].discard(slug)
+    if not by_server[server_id]:
+        del by_server[server_id]
+    last = drop_watcher(slug, server_id)
+    leaderboard.remove_player(server_id, slug)
+    await db_manager.remove_watch(server_id, slug)
+    if last:
+        await leaderboard.forget(slug)
+    return True
+
+
+async def remove_server(server_id):
+    # The server's watchlist rows are already gone with the rest of its settings
+    leaderboard.remove_server(server_id)
+    dropped = [slug for slug in by_server.pop(server_id, ()) if drop_watcher(slug, server_id)]
+    for slug in dropped:
+        await leaderboard.forget(slug)
+
+
+def drop_watcher(slug, server_id):
+    # True if no server watches the player any more, its leaderboard values are forgotten then so watching it
+    # again starts from fresh stats
+    watchers[slug].discard(server_id)
+    if watchers[slug]:
+        return False
+    del watchers[slug]
+    snapshots.pop(slug, None)
+    return True
+
+
+def format_delta(delta):
+    return ("+" if delta > 0 else "") + str(delta)
+
+
+def diff_stats(old, new):
+    lines = []
+    changes = [format_delta(new.get(field, 0) - old.get(field, 0)) + " " + field for field in COUNTED_FIELDS
+               if new.get(field, 0) != old.get(field, 0)]
+    if changes:
+        lines.append(", ".join(changes))
+    if new.get("kpg") != old.get("kpg"):
+        try:
+            delta = " (" + format(float(new["kpg"]) - float(old["kpg"]), "+.2f") + ")"
+        except (KeyError, TypeError, ValueError):
+            delta = ""
+        lines.append("KPG " + str(old.get("kpg")) + " -> " + str(new.get("kpg")) + delta)
+
+    for name, old_mode, new_mode in zip(MODE_NAMES, old.get("modes", ()), new.get("modes", ())):
+        changes = [format_delta(new_mode.get(field, 0) - old_mode.get(field, 0)) + " " + field
+                   for field in ("kills", "wins") if new_mode.get(field, 0) != old_mode.get(field, 0)]
+        if changes:
+            lines.append(name + ": " + ", ".join(changes))
+    return lines
+
+
+async def store(slug, stats):
+    snapshots[slug] = stats
+    await db_manager.save_player_stats(slug, dumps(stats))
+    await leaderboard.update(slug, stats, watchers.get(slug, ()))
+
+
+async def update(slug, stats):
+    # New stats for a watched player, from the poller or from someone using the stats command
+    old = snapshots.get(slug)
+    if not stats or stats == old:
+        return
+    await store(slug, stats)
+    if old is None:
+        return
+    # The first stats seen are only a baseline
+
+    lines = diff_stats(old, stats)
+    if lines and on_changes and slug in watchers:
+        await on_changes(sorted(watchers[slug]), stats, lines)
+
+
+async def poll_once():
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def poll(slug):
+        async with semaphore:
+            try:
+                stats = await fetch(slug)
+            except surviv_api.RequestFailed:
+                logger.info("Couldn't get stats for watched player %s", slug, extra={"sample": 10})
+                return
+        try:
+            await update(slug, stats)
+        except Exception:
+            logger.exception("Failed to update watched player %s", slug)
+
+    await asyncio.gather(*(poll(slug) for slug in list(watchers)))
+
+
+async def poll_forever():
+    while True:
+        await asyncio.sleep(poll_interval)
+        try:
+            await poll_once()
+        except Exception:
+            logger.exception("Watchlist poll failed")
+
+
+def start():
+    global task
+    if task is None or task.done():
+        task = asyncio.ensure_future(poll_forever())
+        logger.info("Watchlist poller started, polling every %ss", poll_interval)
+
+
+def stop():
+    global task
+    if task is not None:
+        task.cancel()
+        task = None